@@ -0,0 +1,47 @@
+"""Tokenizing and matching argv of 10^3 up to 10^6 file names.
+
+Times `parse_args` alone and a whole `docopt` call for a program taking
+`<file>...`, and prints the time per argument, which should stay about
+constant as argv grows.
+
+Usage: python benchmarks/bench_argv.py [<repeat>]
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import docopt
+
+
+SIZES = 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6
+
+doc = '''Usage: prog [-v] [--output=<dir>] <file>...
+
+-v              Verbose.
+--output=<dir>  Where to write results.
+
+'''
+
+
+def main(repeat=3):
+    options = docopt.parse_doc_options(doc)
+    phases = [
+        ('parse_args', lambda argv: docopt.parse_args(argv, options)),
+        ('docopt', lambda argv: docopt.docopt(doc, argv)),
+    ]
+    print('%-12s' % 'us per arg' + ''.join('%10d' % n for n in SIZES))
+    for name, phase in phases:
+        row = []
+        for size in SIZES:
+            argv = ['-v', '--output=out'] + ['file%07d' % i
+                                             for i in range(size)]
+            seconds = min(timeit.repeat(lambda: phase(argv), number=1,
+                                        repeat=repeat))
+            row.append(seconds * 1e6 / len(argv))
+        print('%-12s' % name + ''.join('%10.2f' % t for t in row))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
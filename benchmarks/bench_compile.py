@@ -0,0 +1,50 @@
+"""Compiling usage patterns of 250 up to 2,000 leaves.
+
+Times `parse_pattern`, `Fragment.flat`, `fix_list_arguments` and
+`build_pattern` on a single long sequence of commands, arguments and
+options, and prints the time per leaf, which should stay about constant
+as the pattern grows.
+
+Usage: python benchmarks/bench_compile.py [<repeat>]
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import docopt
+
+
+SIZES = 250, 500, 1000, 2000
+
+
+def source(leaves):
+    words = []
+    for i in range(leaves // 3 + 1):
+        words.extend(['cmd%04d' % i, '<arg%04d>' % i, '--opt%04d' % i])
+    return '( %s )' % ' '.join(words[:leaves])
+
+
+def main(repeat=5):
+    phases = [
+        ('parse_pattern', lambda src: docopt.parse_pattern(src, [])),
+        ('flat', lambda src: docopt.parse_pattern(src, []).flat),
+        ('fix_list_arguments',
+         lambda src: docopt.parse_pattern(src, []).fix_list_arguments()),
+        ('build_pattern', lambda src: docopt.build_pattern(
+            docopt.parse_pattern(src, []).fix_list_arguments())),
+    ]
+    print('%-20s' % 'us per leaf' + ''.join('%10d' % n for n in SIZES))
+    for name, phase in phases:
+        row = []
+        for leaves in SIZES:
+            src = source(leaves)
+            seconds = min(timeit.repeat(lambda: phase(src), number=1,
+                                        repeat=repeat))
+            row.append(seconds * 1e6 / leaves)
+        print('%-20s' % name + ''.join('%10.2f' % t for t in row))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,59 @@
+"""Option matching with 200 declared options and 50 supplied flags.
+
+Compares `Option.next` looking the option up in `ParsedArgs.masks` with
+scanning every supplied option for each option node visited, as it was
+done before options were indexed.
+
+Usage: python benchmarks/bench_options.py [<repeat>]
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import docopt
+
+
+DECLARED, SUPPLIED = 200, 50
+
+doc = 'Usage: prog %s\n\n%s' % (
+    ' '.join('[--option-%03d]' % i for i in range(DECLARED)),
+    '\n'.join('--option-%03d  Option number %d.' % (i, i)
+              for i in range(DECLARED)))
+argv = ['--option-%03d' % i for i in range(0, DECLARED, DECLARED // SUPPLIED)]
+
+
+def scanning_next(self, argv, cursor, mask, collected):
+    matching = 0
+    for i, arg in enumerate(argv.options):
+        if (self.short, self.long) == (arg.short, arg.long):
+            matching |= 1 << i
+    if matching & ~mask:
+        return docopt.Literal.next(self, argv, cursor, mask | matching,
+                                   collected)
+    return None
+
+
+def main(repeat=20):
+    parser = docopt.Parser(doc)
+    args = docopt.parse_args(argv, parser.options)
+    match = lambda: docopt.traverse(parser.root, args)
+    expected = match()
+    indexed = min(timeit.repeat(match, number=1, repeat=repeat))
+    indexed_next = docopt.Option.next
+    docopt.Option.next = scanning_next
+    try:
+        assert match() == expected
+        scanning = min(timeit.repeat(match, number=1, repeat=repeat))
+    finally:
+        docopt.Option.next = indexed_next
+    print('traverse() with %d declared options, %d supplied flags' %
+          (DECLARED, len(argv)))
+    print('indexed:  %8.2f ms' % (indexed * 1000))
+    print('scanning: %8.2f ms (%.1fx)' % (scanning * 1000,
+                                          scanning / indexed))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,171 @@
+"""Compile and match phases of synthetic usage docs along scaling axes.
+
+Each axis generates a usage doc (and a matching argv) of growing size:
+
+  lines       usage lines `prog cmdN <x> [-v]`, argv matching the last one
+  options     `[options]` with N declared flags, half of them supplied
+  depth       N nested `[cmdN ...]` groups, argv supplying all commands
+  repetition  N repeated `<argN>...` arguments, two values each (every
+              split of the values is a distinct matcher state, so this
+              axis grows exponentially and is kept short)
+  argv        `prog [-v] <x>...` with N positional values
+
+`parse_pattern` (with the usage and options sections it needs),
+`build_pattern`, `parse_args` and `traverse` are timed separately, with the
+peak memory allocated by each, and compared to compiling and running an
+equivalent `argparse` parser where there is one (argparse has no nested
+groups). Times are the best of <n> runs.
+
+Usage: bench_scaling.py [--repeat=<n>] [--json=<file>] [<axis>...]
+
+--repeat=<n>   Runs per measurement [default: 5].
+--json=<file>  Also write the results there, for regression tracking.
+
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import docopt
+
+
+SIZES = 10, 20, 40, 80
+
+
+def lines(n):
+    doc = 'Usage:\n' + '\n'.join('  prog cmd%03d <x> [-v]' % i
+                                 for i in range(n))
+    def build():
+        parser = argparse.ArgumentParser(prog='prog')
+        commands = parser.add_subparsers()
+        for i in range(n):
+            command = commands.add_parser('cmd%03d' % i)
+            command.add_argument('x')
+            command.add_argument('-v', action='store_true')
+        return parser
+    return doc, ['cmd%03d' % (n - 1), 'x', '-v'], build
+
+
+def options(n):
+    doc = 'Usage: prog [options]\n\n' + '\n'.join(
+        '--opt-%03d  Option number %d.' % (i, i) for i in range(n))
+    def build():
+        parser = argparse.ArgumentParser(prog='prog')
+        for i in range(n):
+            parser.add_argument('--opt-%03d' % i, action='store_true')
+        return parser
+    return doc, ['--opt-%03d' % i for i in range(0, n, 2)], build
+
+
+def depth(n):
+    doc = 'Usage: prog %s%s' % (''.join('[cmd%03d ' % i for i in range(n)),
+                                ']' * n)
+    return doc, ['cmd%03d' % i for i in range(n)], None
+
+
+def repetition(n):
+    doc = 'Usage: prog %s' % ' '.join('<arg%03d>...' % i for i in range(n))
+    def build():
+        parser = argparse.ArgumentParser(prog='prog')
+        for i in range(n):
+            parser.add_argument('arg%03d' % i, nargs='+')
+        return parser
+    return doc, ['value'] * (2 * n), build
+
+
+def argv(n):
+    doc = 'Usage: prog [-v] <x>...'
+    def build():
+        parser = argparse.ArgumentParser(prog='prog')
+        parser.add_argument('-v', action='store_true')
+        parser.add_argument('x', nargs='+')
+        return parser
+    return doc, ['-v'] + ['value'] * n, build
+
+
+AXES = [('lines', lines, SIZES), ('options', options, SIZES),
+        ('depth', depth, SIZES), ('repetition', repetition, (2, 4, 6, 8)),
+        ('argv', argv, SIZES)]
+
+
+def measure(phase, setup, repeat):
+    """Best time in seconds and peak bytes allocated by `phase(setup())`."""
+    best = None
+    for _ in range(repeat):
+        value = setup()
+        start = time.perf_counter()
+        phase(value)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    value = setup()
+    tracemalloc.start()
+    try:
+        phase(value)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run(generate, n, repeat):
+    doc, argv, build = generate(n)
+    table = docopt.OptionTable(docopt.parse_doc_options(doc))
+    usage = docopt.formal_usage(docopt.printable_usage(doc))
+    pattern = lambda: docopt.parse_pattern(usage, table).fix_list_arguments()
+    root = docopt.build_pattern(pattern())
+    args = docopt.parse_args(argv, table)
+    assert docopt.traverse(root, args) is not False
+    phases = [
+        ('parse_pattern', lambda _: docopt.parse_pattern(
+            docopt.formal_usage(docopt.printable_usage(doc)),
+            docopt.OptionTable(docopt.parse_doc_options(doc))), lambda: None),
+        ('build_pattern', docopt.build_pattern, pattern),
+        ('parse_args', lambda _: docopt.parse_args(argv, table), lambda: None),
+        ('traverse', lambda _: docopt.traverse(root, args), lambda: None),
+    ]
+    if build is not None:
+        phases.append(('argparse', lambda _: build().parse_args(argv),
+                       lambda: None))
+    result = {}
+    for name, phase, setup in phases:
+        seconds, peak = measure(phase, setup, repeat)
+        result[name] = {'seconds': seconds, 'peak_bytes': peak}
+    result['docopt'] = dict(
+        (key, sum(result[p][key] for p, _, _ in phases[:4]))
+        for key in ('seconds', 'peak_bytes'))
+    return result
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    repeat = int(arguments['--repeat'])
+    axes = [(name, generate, sizes) for name, generate, sizes in AXES
+            if not arguments['<axis>'] or name in arguments['<axis>']]
+    results = {}
+    columns = ['parse_pattern', 'build_pattern', 'parse_args', 'traverse',
+               'docopt', 'argparse']
+    print('%-12s%6s' % ('ms (KiB)', 'n') +
+          ''.join('%20s' % c for c in columns))
+    for name, generate, sizes in axes:
+        results[name] = {}
+        for n in sizes:
+            result = results[name][n] = run(generate, n, repeat)
+            print('%-12s%6d' % (name, n) + ''.join(
+                '%20s' % ('%.3f (%d)' % (result[c]['seconds'] * 1000,
+                                         result[c]['peak_bytes'] // 1024)
+                          if c in result else '-') for c in columns))
+    if arguments['--json']:
+        f = open(arguments['--json'], 'w')
+        try:
+            json.dump({'repeat': repeat, 'results': results}, f, indent=1,
+                      sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Start-up cost of a short-lived program using docopt.
+
+Runs fresh interpreters to measure `import docopt` (from `-X importtime`,
+with the modules it pulls in that an empty interpreter does not load) and
+the latency of the first and second call parsing the naval fate and git
+examples: `docopt()`, which compiles the doc, `docopt()` loading it from a
+warm $DOCOPT_CACHE_DIR, and `remote_docopt()` with a warm `ParseServer`.
+Times are the best of <repeat> runs, in milliseconds.
+
+Usage: python benchmarks/bench_startup.py [<repeat>]
+
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+EXAMPLES = [
+    ('naval_fate', ['ship', 'Guardian', 'move', '10', '50', '--speed=20']),
+    ('git_example', ['remote', 'add', '-t', 'dev', 'origin', 'url']),
+]
+
+FIRST_CALL = r'''
+import sys
+import time
+doc = open('examples/%s.py' % sys.argv[2]).read().split('"""')[1]
+argv = sys.argv[3:]
+start = time.perf_counter()
+import docopt
+imported = time.perf_counter()
+call = getattr(docopt, sys.argv[1])
+call(doc, argv)
+first = time.perf_counter()
+call(doc, argv)
+second = time.perf_counter()
+print('%f %f %f' % (imported - start, first - imported, second - first))
+'''
+
+
+def python(*args, **env):
+    return subprocess.run([sys.executable] + list(args), cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True,
+                          env=dict(os.environ, **env))
+
+
+def imports(code):
+    """Map module names to their cumulative import time in microseconds."""
+    times = {}
+    for line in python('-X', 'importtime', '-c', code).stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def calls(repeat, title, function, example, argv, **env):
+    python('-c', FIRST_CALL, function, example, *argv, **env)  # warm caches
+    runs = [[float(t) * 1000 for t in
+             python('-c', FIRST_CALL, function, example, *argv,
+                    **env).stdout.split()]
+            for _ in range(repeat)]
+    print('%s on %s:' % (title, example))
+    for label, i in [('import (timed in-process)', 0), ('first call', 1),
+                     ('second call', 2)]:
+        print('  %-26s %8.2f ms' % (label + ':', min(r[i] for r in runs)))
+
+
+def main(repeat=10):
+    baseline = set(imports('pass'))
+    best = None
+    for _ in range(repeat):
+        times = imports('import docopt')
+        if best is None or times['docopt'] < best['docopt']:
+            best = times
+    print('import docopt: %8.2f ms' % (best['docopt'] / 1000.0))
+    if sys.dont_write_bytecode:
+        print('  (bytecode is not cached, so this includes compiling '
+              'docopt.py)')
+    print('modules not loaded by an empty interpreter:')
+    for name in sorted(set(best) - baseline, key=best.get, reverse=True):
+        if name != 'docopt':
+            print('  %-30s %8.2f ms' % (name, best[name] / 1000.0))
+    directory = tempfile.mkdtemp()
+    socket = os.path.join(directory, 'docopt.sock')
+    server = subprocess.Popen([sys.executable, '-m', 'docopt',
+                               '--serve=' + socket], cwd=ROOT)
+    try:
+        while not os.path.exists(socket):
+            time.sleep(0.01)
+        for example, argv in EXAMPLES:
+            calls(repeat, 'docopt()', 'docopt', example, argv,
+                  DOCOPT_CACHE_DIR='')
+            calls(repeat, 'docopt() with disk cache', 'docopt', example, argv,
+                  DOCOPT_CACHE_DIR=os.path.join(directory, 'cache'))
+            calls(repeat, 'remote_docopt()', 'remote_docopt', example, argv,
+                  DOCOPT_SOCKET=socket)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -1,14 +1,24 @@
-from copy import copy, deepcopy
+from __future__ import with_statement
+from bisect import bisect_left, insort
 import sys
 import re
 
 
+__version__ = '0.4.1'
+
+
 #Python 3 Compatibility
 try:
     basestring
 except NameError:
     basestring = str
 
+# Same as threading.Lock, without importing threading at start-up.
+try:
+    from _thread import allocate_lock as Lock
+except ImportError:
+    from thread import allocate_lock as Lock
+
 
 class DocoptLanguageError(Exception):
 
@@ -23,10 +33,38 @@ class DocoptExit(SystemExit):
 
     def __init__(self, message=''):
         SystemExit.__init__(self, (message + '\n' + self.usage).strip())
+        self.message = message
+
+
+class ParseError(Exception):
+
+    """Argv which did not match, as yielded by `Parser.parse_many`.
+
+    Unlike `DocoptExit`, it does not exit the program if raised. `message`
+    is what went wrong ('' if argv just did not match the pattern) and
+    `str()` of it is the message followed by `usage`, as for `DocoptExit`.
+
+    """
+
+    def __init__(self, message, usage):
+        Exception.__init__(self, (message + '\n' + usage).strip())
+        self.message, self.usage = message, usage
+
+    def __reduce__(self):
+        return (ParseError, (self.message, self.usage))
 
 
 class Fragment(object):
 
+    _edges = ()
+    # Attributes only needed while building or matching, not serialized.
+    _transient = ('tails', '_closures', '_key')
+    # Whether `key` is cached: only for nodes whose structure includes
+    # other nodes, so that leaves are cheap to create and compare.
+    _cached_key = False
+    # Offset of the node's token in the formal usage pattern, if known.
+    position = None
+
     def __init__(self):
         self.tails = []
 
@@ -36,20 +74,69 @@ class Fragment(object):
     def assemble(self):
         raise NotImplementedError()
 
-    def next(self, args, collected):
+    def next(self, argv, cursor, mask, collected):
+        """Match against `argv` in state (cursor, mask, collected).
+
+        Return the next (node, cursor, mask, collected) state, or None if
+        the branch fails. See `ParsedArgs` and `collect`.
+
+        """
         raise NotImplementedError()
 
+    def structure(self):
+        """Tuple describing the node, used for equality and hashing.
+
+        Child nodes are included as they are, so hashing the tuple uses
+        their cached hashes instead of walking their subtrees again.
+
+        """
+        if hasattr(self, 'children'):
+            return (self.__class__, self.children)
+        return (self.__class__,)
+
+    def key(self):
+        """Return (structure, hash), see `forget` for cached keys."""
+        key = self.__dict__.get('_key')
+        if key is None:
+            structure = self.structure()
+            key = (structure, hash(structure))
+            if self._cached_key:
+                self._key = key
+        return key
+
+    def forget(self):
+        """Drop the cached keys of the subtree, once its nodes changed."""
+        for node in self.walk():
+            node.__dict__.pop('_key', None)
+        return self
+
     def __eq__(self, other):
-        return repr(self) == repr(other)
+        if self is other:
+            return True
+        if not isinstance(other, Fragment):
+            return NotImplemented
+        structure, hash_ = self.key()
+        other_structure, other_hash = other.key()
+        return hash_ == other_hash and structure == other_structure
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
     def __hash__(self):
-        return hash(repr(self))
+        return self.key()[1]
+
+    def walk(self):
+        """Yield the node and all its descendants, depth-first, in order."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(getattr(node, 'children', ())))
 
     @property
     def flat(self):
-        if not hasattr(self, 'children'):
-            return [self]
-        return sum([c.flat for c in self.children], [])
+        return [node for node in self.walk() if not hasattr(node, 'children')]
 
     def __repr__(self):
         if hasattr(self, 'children'):
@@ -59,32 +146,25 @@ class Fragment(object):
     
     def fix_list_arguments(self):
         """Find arguments that should accumulate values and fix them."""
-        either = [list(c.children) for c in self.either.children]
-        repeats = set()
-        nodes_by_repr = {}
+        occurrences = self.occurrences()
+        if occurrences is None:
+            return self
+        repeats = [node for node in self.walk()
+                   if occurrences.get(node, 0) > 1]
 
-        #Index all nodes by repr
-        for case in either:
-            nodes_in_case = set()
+        #Update value of nodes that re-occur
+        for node in repeats:
+            node.value = []
 
-            for child in case:
-                if not isinstance(child, Argument):
-                    continue
+        return self.forget()
 
-                #Check if node has repeated within case
-                if child in nodes_in_case:
-                    repeats.add(child)
-                else:
-                    nodes_in_case.add(child)
+    def occurrences(self):
+        """Map arguments to how often they occur in some case of `either`.
 
-                nodes_by_repr[child] = nodes_by_repr.get(child, []) + [child]
+        Counts are capped at 2 ("many"); None means there is no case at all.
 
-        #Update value of nodes that re-occur
-        for node in repeats:
-            for node in nodes_by_repr[node]:
-                node.value = []
-
-        return self
+        """
+        return {}
 
     @property
     def either(self):
@@ -94,10 +174,11 @@ class Fragment(object):
         if not hasattr(self, 'children'):
             return Either(Required(self))
         else:
+            from collections import deque
             ret = []
-            groups = [[self]]
+            groups = deque([[self]])
             while groups:
-                children = groups.pop(0)
+                children = groups.popleft()
                 types = [type(c) for c in children]
                 if Either in types:
                     either = [c for c in children if type(c) is Either][0]
@@ -123,12 +204,14 @@ class Fragment(object):
 
 class Literal(Fragment):
 
+    _edges = ('_next',)
+
     def __init__(self):
         Fragment.__init__(self)
         self._next = None
 
-    def next(self, args, collected):
-        return self._next
+    def next(self, argv, cursor, mask, collected):
+        return self._next, cursor, mask, collected
 
     def patch(self, node):
         if not self._next:
@@ -144,11 +227,39 @@ class Literal(Fragment):
 
 class Split(Literal):
 
+    _edges = ('out1', 'out2')
+    _cached_key = True
+
     def __init__(self, out1=None, out2=None):
         Fragment.__init__(self)
         self.out1 = out1
         self.out2 = out2
         self._is_recursive = False
+        self._closures = {}
+
+    def closure(self, token):
+        """Non-split nodes reachable from here that may accept `token`.
+
+        `token` is the next positional argument (None if there is none).
+        Nodes are listed in the order `traverse` would have forked them;
+        those that need a different positional argument next (according
+        to `first`, see `determinize`) are left out. Results are cached
+        per distinct command name, so the cache stays small.
+
+        """
+        if token is not None and token not in self.first:
+            token = ANY
+        if token not in self._closures:
+            leaves, stack = [], [self]
+            while stack:
+                node = stack.pop()
+                if isinstance(node, Split):
+                    stack += [node.out2, node.out1]
+                elif (None in node.first if token is None else
+                      token in node.first or ANY in node.first):
+                    leaves.append(node)
+            self._closures[token] = leaves
+        return self._closures[token]
 
     def patch(self, node):
         if not self.out1:
@@ -163,6 +274,11 @@ class Split(Literal):
     def flat(self):
         raise RuntimeError("Flat not computable after pattern is built.")
 
+    def structure(self):
+        if self._is_recursive:
+            return (Split, 'recursive', self.out2)
+        return (Split, self.out1, self.out2)
+
     def __repr__(self):
         if self._is_recursive:
             return 'Split(RecursiveNode, %r)' % (self.out2)
@@ -177,27 +293,20 @@ class Argument(Literal):
         self.name = name
         self.value = value
 
-    def next(self, args, collected):
-        if not args:
+    def next(self, argv, cursor, mask, collected):
+        if cursor == len(argv.arguments):
             return None
+        item = (Argument, self.name, argv.arguments[cursor],
+                isinstance(self.value, list))
+        return Literal.next(self, argv, cursor + 1, mask, (item, collected))
 
-        for i, arg in enumerate(args):
-            if isinstance(arg, Argument):
-                args.pop(i)
-                if isinstance(self.value, list):
-                    found = False
-                    for v in collected:
-                        if not isinstance(v, Argument) or v.name != self.name:
-                            continue
-                        v.value.append(arg.value)
-                        found = True
-                        break
-                    if not found:
-                        collected.append(Argument(self.name, [arg.value]))
-                else:
-                    collected.append(Argument(self.name, arg.value))
-                return Literal.next(self, args, collected)
-        return None
+    def occurrences(self):
+        return {self: 1}
+
+    def structure(self):
+        value = self.value
+        return (self.__class__, self.name,
+                (list, tuple(value)) if isinstance(value, list) else value)
 
     def __repr__(self):
         return '%s(%r, %r)' % (self.__class__.__name__, self.name, self.value)
@@ -211,19 +320,17 @@ class Command(Literal):
         self.name = name
         self.value = value
 
-    def next(self, args, collected):
-        if not args:
+    def next(self, argv, cursor, mask, collected):
+        if cursor == len(argv.arguments) or \
+                argv.arguments[cursor] != self.name:
             return None
+        item = (Command, self.name, True, False)
+        return Literal.next(self, argv, cursor + 1, mask, (item, collected))
 
-        for i, arg in enumerate(args):
-            if isinstance(arg, Argument):
-                if arg.value == self.name:
-                    args.pop(i)
-                    collected.append(Command(self.name, True))
-                    return Literal.next(self, args, collected)
-                else:
-                    return None
-        return None
+    def structure(self):
+        value = self.value
+        return (self.__class__, self.name,
+                (list, tuple(value)) if isinstance(value, list) else value)
 
     def __repr__(self):
         return '%s(%r, %r)' % (self.__class__.__name__, self.name, self.value)
@@ -231,7 +338,7 @@ class Command(Literal):
 
 class End(Fragment):
 
-    def next(self, args, collected):
+    def next(self, argv, cursor, mask, collected):
         return None
 
     def patch(self, node):
@@ -240,43 +347,51 @@ class End(Fragment):
 
 class Option(Literal):
 
-    def __init__(self, short=None, long=None, argcount=0, value=False):
+    _default = re.compile(r'\[default: (.*)\]', re.I)
+
+    def __init__(self, short=None, long=None, argcount=0, value=False,
+                 aliases=()):
         Literal.__init__(self)
         assert argcount in (0, 1)
         self.short, self.long = short, long
         self.argcount, self.value = argcount, value
         self.value = None if value == False and argcount else value  # HACK
+        self.aliases = tuple(aliases)
 
     @classmethod
     def parse(class_, option_description):
         short, long, argcount, value = None, None, 0, False
+        aliases = []
         options, _, description = option_description.strip().partition('  ')
         options = options.replace(',', ' ').replace('=', ' ')
         for s in options.split():
             if s.startswith('--'):
-                long = s
+                if long is None:
+                    long = s
+                else:
+                    aliases.append(s)
             elif s.startswith('-'):
-                short = s
+                if short is None:
+                    short = s
+                else:
+                    aliases.append(s)
             else:
                 argcount = 1
         if argcount:
-            matched = re.findall('\[default: (.*)\]', description, flags=re.I)
+            matched = class_._default.findall(description)
             value = matched[0] if matched else None
-        return class_(short, long, argcount, value)
-
-    def next(self, args, collected):
-        i = len(args) - 1
-        found = False
-        while i >= 0:
-            arg = args[i]
-            if isinstance(arg, Option):
-                if (self.short, self.long) == (arg.short, arg.long):
-                    # collected.append(self)
-                    args.pop(i)
-                    found = True
-            i -= 1
-        if found:
-            return Literal.next(self, args, collected)
+        return class_(short, long, argcount, value, aliases)
+
+    @property
+    def names(self):
+        """Short and long name followed by any further aliases."""
+        return tuple(n for n in (self.short, self.long) if n) + self.aliases
+
+    def next(self, argv, cursor, mask, collected):
+        # All occurrences of the option are consumed at once
+        matching = argv.masks.get((self.short, self.long), 0)
+        if matching & ~mask:
+            return Literal.next(self, argv, cursor, mask | matching, collected)
         else:
             return None
 
@@ -284,34 +399,47 @@ class Option(Literal):
     def name(self):
         return self.long or self.short
 
+    def structure(self):
+        return (Option, self.short, self.long, self.argcount, self.value,
+                self.aliases)
+
     def __repr__(self):
+        if self.aliases:
+            return 'Option(%r, %r, %r, %r, %r)' % (self.short, self.long,
+                                                   self.argcount, self.value,
+                                                   self.aliases)
         return 'Option(%r, %r, %r, %r)' % (self.short, self.long,
                                            self.argcount, self.value)
 
 
 class AnyOptions(Literal):
 
-    def next(self, args, collected):
-        i = len(args) - 1
-        found = False
-        while i >= 0:
-            arg = args[i]
-            if isinstance(arg, Option):
-                args.pop(i)
-                found = True
-            i -= 1
-        if found:
-            return Literal.next(self, args, collected)
+    def next(self, argv, cursor, mask, collected):
+        if argv.all_options & ~mask:
+            return Literal.next(self, argv, cursor, argv.all_options,
+                                collected)
         else:
             return None
 
 
 class Container(Fragment):
 
+    _cached_key = True
+
     def __init__(self, *children):
         Fragment.__init__(self)
         self.children = children
 
+    def occurrences(self):
+        total = {}
+        for child in self.children:
+            counts = child.occurrences()
+            if counts is None:
+                return None
+            for node, n in counts.items():
+                total[node] = min(total.get(node, 0) + n, 2)
+        return total
+
 
 class Required(Container):
 
@@ -324,6 +452,9 @@ class Required(Container):
         for node in assembled[1:]:
             previous.patch(node)
             previous = node
+        if previous is not root:
+            # Patch the last node directly, instead of through every node
+            root.tails = [previous]
         return root
 
 
@@ -333,10 +464,13 @@ class Optional(Container):
         assert self.children
         if len(self.children) > 1:
             #Optional must apply to children individually
-            root = Required(*[Optional(c) for c in self.children])
-            return root.assemble()
+            optionals = [Optional(c) for c in self.children]
+            for optional in optionals:
+                optional.position = self.position
+            return Required(*optionals).assemble()
         else:
             split = Split()
+            split.position = self.position
             split.out1 = self.children[0].assemble()
             split.tails = [split.out1]
             return split
@@ -361,47 +495,211 @@ class OneOrMore(Container):
         split = Split()
         split.out1 = dummy
         split._is_recursive = True
+        split.position = self.position
         assert not split.tails
         res.patch(split)
         return res
 
+    def occurrences(self):
+        total = Container.occurrences(self)
+        return total and dict((node, 2) for node in total)
+
 
 class Either(Container):
 
+    def occurrences(self):
+        best = None
+        for child in self.children:
+            counts = child.occurrences()
+            if counts is None:
+                continue
+            if best is None:
+                best = counts
+            else:
+                for node, n in counts.items():
+                    best[node] = max(best.get(node, 0), n)
+        return best
+
     def assemble(self):
         assembled = [c.assemble() for c in self.children]
         assert assembled
         assert len(assembled) > 1
         previous = Split(assembled[-2], assembled[-1])
         previous.tails = [assembled[-2], assembled[-1]]
+        previous.position = self.position
         for node in assembled[:-2]:
             previous = Split(node, previous)
             previous.tails = [node, previous.out2]
+            previous.position = self.position
         return previous
 
 
-class TokenStream(list):
+class TokenStream(object):
+
+    """Tokens consumed from the front by advancing a cursor.
+
+    Iterating or taking the length only sees the tokens not yet moved past.
+
+    """
+
+    position = None
 
     def __init__(self, source, error):
-        self += source.split() if isinstance(source, basestring) else source
+        self._tokens = (source.split() if isinstance(source, basestring)
+                        else list(source))
+        self._cursor = 0
         self.error = error
 
+    def _next_match(self):
+        for match in self._scanner:  # next(scanner, None) needs 2.6
+            return match
+        return None
+
     def move(self):
-        return self.pop(0) if len(self) else None
+        token = self.current()
+        if token is not None:
+            self._cursor += 1
+        return token
 
     def current(self):
-        return self[0] if len(self) else None
+        if self._cursor < len(self._tokens):
+            return self._tokens[self._cursor]
+        return None
+
+    def __iter__(self):
+        return iter(self._tokens[self._cursor:])
+
+    def __len__(self):
+        return len(self._tokens) - self._cursor
+
+
+class PatternTokenStream(TokenStream):
+
+    """Tokens of a usage pattern, scanned lazily as they are reached.
+
+    `position` is the offset in `source` of the token last looked at, so
+    that errors can point at it. If `source` is the `formal_usage` of
+    `usage`, errors point into `usage` instead, by line and column.
+
+    """
+
+    _token = re.compile(r'\.\.\.|[\[\]()|]|(?:(?!\.\.\.)[^\s\[\]()|])+')
+
+    def __init__(self, source, usage=None):
+        self.source = source
+        self.usage = usage
+        self.position = 0
+        self._scanner = self._token.finditer(source)
+        self._match = self._next_match()
+
+    def _next_match(self):
+        for match in self._scanner:  # next(scanner, None) needs 2.6
+            return match
+        return None
+
+    def move(self):
+        token = self.current()
+        if token is not None:
+            self._match = self._next_match()
+        return token
+
+    def current(self):
+        if self._match is None:
+            self.position = len(self.source)
+            return None
+        self.position = self._match.start()
+        return self._match.group()
+
+    def __iter__(self):
+        if self._match is not None:
+            rest = [self._match] + list(self._scanner)
+            self._scanner = iter(rest[1:])
+            for match in rest:
+                yield match.group()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def error(self, message):
+        if self.usage is None:
+            return DocoptLanguageError('%s\n    %s\n    %s^' % (
+                message, self.source, ' ' * self.position))
+        # Brackets and bars added by `formal_usage` are not in `usage`:
+        # point just after the closest word written before them instead.
+        locate, start = _usage_locator(self.usage), self.position
+        while start > 0 and locate(start) is None:
+            start -= 1
+        line, column = locate(start) or (1, 1)
+        text = self.usage.split('\n')[line - 1]
+        column = min(column + self.position - start, len(text) + 1)
+        return DocoptLanguageError('%s at line %d, column %d:\n    %s\n    %s^'
+                                   % (message, line, column, text,
+                                      ' ' * (column - 1)))
+
+
+class OptionTable(object):
+
+    """Options of a grammar, indexed for lookups by name.
+
+    It wraps (and appends to) a plain list of options. Long names are kept
+    sorted, so options matching a prefix are found by bisection instead of
+    by comparing the prefix with every option, and short names are mapped
+    from their letter. Every alias of an option is indexed the same way.
+
+    """
+
+    def __init__(self, options):
+        self.options, self._longs, self._shorts = [], [], {}
+        for option in options:
+            self.append(option)
+        self.options = options  # so that appends reach the caller's list
+
+    @classmethod
+    def of(class_, options):
+        return options if isinstance(options, class_) else class_(options)
+
+    def append(self, option):
+        i = len(self.options)
+        for name in option.names:
+            if name.startswith('--'):
+                insort(self._longs, (name, i))
+            elif name.lstrip('-'):
+                self._shorts.setdefault(name.lstrip('-')[0], []).append(i)
+        self.options.append(option)
+
+    def __iter__(self):
+        return iter(self.options)
+
+    def __len__(self):
+        return len(self.options)
+
+    def match_long(self, prefix):
+        """Options with a long name starting with `prefix`, in order."""
+        found = set()
+        i = bisect_left(self._longs, (prefix,))
+        while i < len(self._longs) and self._longs[i][0].startswith(prefix):
+            found.add(self._longs[i][1])
+            i += 1
+        return [self.options[i] for i in sorted(found)]
+
+    def match_short(self, letter):
+        """Options with a short name `-<letter>`, in order."""
+        return [self.options[i] for i in sorted(set(
+                self._shorts.get(letter, ())))]
 
 
 def parse_long(tokens, options):
     raw, eq, value = tokens.move().partition('=')
+    position = tokens.position
     value = None if eq == value == '' else value
-    opt = [o for o in options if o.long and o.long.startswith(raw)]
+    opt = options.match_long(raw)
     if len(opt) < 1:
         if tokens.error is DocoptExit:
             raise tokens.error('%s is not recognized' % raw)
         else:
             o = Option(None, raw, (1 if eq == '=' else 0))
+            if position is not None:
+                o.position = position
             options.append(o)
             return [o]
     if len(opt) > 1:
@@ -409,6 +707,8 @@ def parse_long(tokens, options):
                          (raw, ', '.join('%s' % o.long for o in opt)))
     o = opt[0]
     opt = Option(o.short, o.long, o.argcount, o.value)
+    if position is not None:
+        opt.position = position
     if opt.argcount == 1:
         if value is None:
             if tokens.current() is None:
@@ -422,10 +722,10 @@ def parse_long(tokens, options):
 
 def parse_shorts(tokens, options):
     raw = tokens.move()[1:]
+    position, length = tokens.position, len(raw)
     parsed = []
     while raw != '':
-        opt = [o for o in options
-               if o.short and o.short.lstrip('-').startswith(raw[0])]
+        opt = options.match_short(raw[0])
         if len(opt) > 1:
             raise tokens.error('-%s is specified ambiguously %d times' %
                               (raw[0], len(opt)))
@@ -434,12 +734,16 @@ def parse_shorts(tokens, options):
                 raise tokens.error('-%s is not recognized' % raw[0])
             else:
                 o = Option('-' + raw[0], None)
+                if position is not None:
+                    o.position = position + 1 + length - len(raw)
                 options.append(o)
                 parsed.append(o)
                 raw = raw[1:]
                 continue
         o = opt[0]
         opt = Option(o.short, o.long, o.argcount, o.value)
+        if position is not None:
+            opt.position = position + 1 + length - len(raw)
         raw = raw[1:]
         if opt.argcount == 0:
             value = True
@@ -454,9 +758,9 @@ def parse_shorts(tokens, options):
     return parsed
 
 
-def parse_pattern(source, options):
-    tokens = TokenStream(re.sub(r'([\[\]\(\)\|]|\.\.\.)', r' \1 ', source),
-                         DocoptLanguageError)
+def parse_pattern(source, options, usage=None):
+    options = OptionTable.of(options)
+    tokens = PatternTokenStream(source, usage)
     result = parse_expr(tokens, options)
     if tokens.current() is not None:
         raise tokens.error('unexpected ending: %r' % ' '.join(tokens))
@@ -469,11 +773,16 @@ def parse_expr(tokens, options):
     if tokens.current() != '|':
         return seq
     result = [Required(*seq)] if len(seq) > 1 else seq
+    position = tokens.position
     while tokens.current() == '|':
         tokens.move()
         seq = parse_seq(tokens, options)
         result += [Required(*seq)] if len(seq) > 1 else seq
-    return [Either(*result)] if len(result) > 1 else result
+    if len(result) == 1:
+        return result
+    either = Either(*result)
+    either.position = position
+    return [either]
 
 
 def parse_seq(tokens, options):
@@ -483,6 +792,7 @@ def parse_seq(tokens, options):
         atom = parse_atom(tokens, options)
         if tokens.current() == '...':
             atom = [OneOrMore(*atom)]
+            atom[0].position = tokens.position
             tokens.move()
         result += atom
     return result
@@ -493,59 +803,69 @@ def parse_atom(tokens, options):
              | long | shorts | argument | command ;
     """
     token = tokens.current()
+    position = tokens.position
     result = []
     if token == '(':
         tokens.move()
         result = [Required(*parse_expr(tokens, options))]
         if tokens.move() != ')':
             raise tokens.error("Unmatched '('")
-        return result
     elif token == '[':
         tokens.move()
         result = [Optional(*parse_expr(tokens, options))]
         if tokens.move() != ']':
             raise tokens.error("Unmatched '['")
-        return result
     elif token == 'options':
         tokens.move()
-        return [AnyOptions()]
+        result = [AnyOptions()]
     elif token.startswith('--') and token != '--':
         return parse_long(tokens, options)
     elif token.startswith('-') and token not in ('-', '--'):
         return parse_shorts(tokens, options)
     elif token.startswith('<') and token.endswith('>') or token.isupper():
-        return [Argument(tokens.move())]
+        result = [Argument(tokens.move())]
     else:
-        return [Command(tokens.move())]
+        result = [Command(tokens.move())]
+    result[0].position = position
+    return result
 
 
 def parse_args(source, options):
+    options = OptionTable.of(options)
     tokens = TokenStream(source, DocoptExit)
-    # options = copy(options)
     parsed = []
-    while tokens.current() is not None:
-        if tokens.current() == '--':
+    token = tokens.current()
+    while token is not None:
+        if token == '--':
             return parsed + [Argument(None, v) for v in tokens]
-        elif tokens.current().startswith('--'):
+        elif token.startswith('--'):
             parsed += parse_long(tokens, options)
-        elif tokens.current().startswith('-') and tokens.current() != '-':
+        elif token.startswith('-') and token != '-':
             parsed += parse_shorts(tokens, options)
         else:
             parsed.append(Argument(None, tokens.move()))
+        token = tokens.current()
     return parsed
 
 
+_option_start = re.compile('^ *-|\n *-')
+
+
 def parse_doc_options(doc):
-    return [Option.parse('-' + s) for s in re.split('^ *-|\n *-', doc)[1:]]
+    return [Option.parse('-' + s) for s in _option_start.split(doc)[1:]]
+
+
+_usage_label = re.compile(r'([Uu][Ss][Aa][Gg][Ee]:)')
+_blank_line = re.compile(r'\n\s*\n')
 
 
 def printable_usage(doc):
-    usage_split = re.split(r'([Uu][Ss][Aa][Gg][Ee]:)', doc)
+    usage_split = _usage_label.split(doc)
     if len(usage_split) < 3:
         raise DocoptLanguageError('"usage:" (case-insensitive) not found.')
     if len(usage_split) > 3:
         raise DocoptLanguageError('More than one "usage:" (case-insensitive).')
-    return re.split(r'\n\s*\n', ''.join(usage_split[1:]))[0].strip()
+    return _blank_line.split(''.join(usage_split[1:]))[0].strip()
 
 
 def formal_usage(printable_usage):
@@ -554,11 +874,21 @@ def formal_usage(printable_usage):
     return '( ' + ' '.join(') | (' if s == pu[0] else s for s in pu[1:]) + ' )'
 
 
-def extras(help, version, options, doc):
+def extra(help, version, options):
+    """Return 'help' or 'version' if `extras` would print it, else None."""
     if help and any((o.name in ('-h', '--help')) and o.value for o in options):
+        return 'help'
+    if version and any(o.name == '--version' and o.value for o in options):
+        return 'version'
+    return None
+
+
+def extras(help, version, options, doc):
+    shown = extra(help, version, options)
+    if shown == 'help':
         print(doc.strip())
         exit()
-    if version and any(o.name == '--version' and o.value for o in options):
+    if shown == 'version':
         print(version)
         exit()
 
@@ -571,49 +901,1148 @@ class Dict(dict):
 def build_pattern(pattern):
     pattern = pattern.assemble()
     pattern.patch(End())
-    return pattern
+    return determinize(pattern)
 
 
-def traverse(root, args):
-    next = []
+# Marker in `first` sets for "any positional argument".
+ANY = True
 
-    def append(next, node, args, collected):
-        if isinstance(node, Split):
-            append(next, node.out1, args, collected)
-            append(next, node.out2, copy(args), deepcopy(collected))
+
+def determinize(root):
+    """Compute `first` and `ahead` for every node of a built pattern.
+
+    `first` holds what the node's branch may consume next: command names,
+    ANY for an argument, None if `End` may come first. `ahead` holds the
+    options, by (short, long), it may still consume, ANY for [options].
+
+    """
+    nodes, seen, stack = [], set(), [root]
+    while stack:
+        node = stack.pop()
+        if node is None or id(node) in seen:
+            continue
+        seen.add(id(node))
+        nodes.append(node)
+        stack.extend(getattr(node, e) for e in node._edges)
+    for node in nodes:
+        node.first = node.ahead = frozenset()
+    changed = True
+    while changed:  # until fixpoint, as `OneOrMore` makes loops
+        changed = False
+        for node in reversed(nodes):
+            if isinstance(node, End):
+                first, ahead = frozenset([None]), frozenset()
+            elif isinstance(node, Split):
+                first = node.out1.first | node.out2.first
+                ahead = node.out1.ahead | node.out2.ahead
+            else:
+                first, ahead = node._next.first, node._next.ahead
+                if isinstance(node, Argument):
+                    first = frozenset([ANY])
+                elif isinstance(node, Command):
+                    first = frozenset([node.name])
+                elif isinstance(node, Option):
+                    ahead = ahead | frozenset([(node.short, node.long)])
+                elif isinstance(node, AnyOptions):
+                    ahead = ahead | frozenset([ANY])
+            if (first, ahead) != (node.first, node.ahead):
+                node.first, node.ahead = first, ahead
+                changed = True
+    return root
+
+
+def collect(collected):
+    """Turn collected values into a list of `Argument` and `Command`.
+
+    While matching, collected values are kept in an immutable cons list
+    of `(item, tail)` pairs, newest first, so that forking a branch shares
+    it instead of copying. Items are `(class, name, value, is_list)`;
+    values of list arguments are accumulated here, at the position of
+    their first occurrence.
+
+    """
+    items = []
+    while collected is not None:
+        item, collected = collected
+        items.append(item)
+    result, lists = [], {}
+    for class_, name, value, is_list in reversed(items):
+        if not is_list:
+            result.append(class_(name, value))
+        elif name in lists:
+            lists[name].value.append(value)
         else:
-            next.append((node, args, collected))
+            lists[name] = Argument(name, [value])
+            result.append(lists[name])
+    return result
+
+
+class ParsedArgs(object):
+
+    """Result of `parse_args`, split for matching.
+
+    It is never modified: a matcher state only holds a cursor into the
+    positional `arguments`, which are consumed in order, and a bitmask of
+    the consumed `options`, which may be consumed in any order. `masks`
+    maps each supplied option's (short, long) to the bits of all its
+    occurrences, so an option node is matched with a single lookup.
+
+    """
+
+    def __init__(self, args):
+        self.arguments = [a.value for a in args if isinstance(a, Argument)]
+        self.options = [o for o in args if isinstance(o, Option)]
+        self.all_options = (1 << len(self.options)) - 1
+        self.masks = {}
+        for i, o in enumerate(self.options):
+            key = (o.short, o.long)
+            self.masks[key] = self.masks.get(key, 0) | 1 << i
+
+    def mask(self, options):
+        """Bits of the supplied options among `options` (see `ahead`)."""
+        if ANY in options:
+            return self.all_options
+        mask = 0
+        for key, bits in self.masks.items():
+            if key in options:
+                mask |= bits
+        return mask
+
+    def done(self, cursor, mask):
+        return cursor == len(self.arguments) and mask == self.all_options
+
+
+class TraverseStats(object):
+
+    """Counters of `traverse` calls, to tell why matching some argv is slow.
 
-    append(next, root, copy(args), [])
+    With `nodes`, also counts [node, entered, forked, failed] per node id,
+    see `HeatProfile`.
+
+    """
+
+    def __init__(self, nodes=False):
+        self.steps = self.peak_frontier = self.states = 0
+        self.duplicates = self.pruned = self.splits = self.forks = 0
+        self.cells = 0
+        self.end_step = None
+        self.visits = {}
+        self.nodes = {} if nodes else None
+
+    def node(self, node):
+        """Counters of `node`, see `nodes`."""
+        if id(node) not in self.nodes:
+            self.nodes[id(node)] = [node, 0, 0, 0]
+        return self.nodes[id(node)]
+
+    def as_dict(self):
+        data = dict(self.__dict__, visits=dict(self.visits))
+        del data['nodes']
+        return data
+
+    def __repr__(self):
+        return 'TraverseStats(%s)' % ', '.join(
+            '%s=%r' % i for i in sorted(self.as_dict().items()))
+
+
+def traverse(root, args, stats=None):
+    """Match `args` against the pattern built from `root`.
+
+    Returns the collected arguments, or False if `args` do not match. If
+    `stats` (a `TraverseStats`) is given, it is filled with counters of
+    the exploration.
+
+    """
+    argv = ParsedArgs(args)
+    next = []
+    # Cons cells of collected values, interned by (item, tail), so that
+    # equal values are the same object and can be compared by identity.
+    interned = {}
+    # States already explored, by (node, cursor, mask, collected values).
+    # A state reached again has nothing new to offer: its successors are
+    # (or were) explored through the first copy, at the same or an earlier
+    # step. This bounds the frontier by the number of distinct states and
+    # terminates loops like `[NAME]...` which do not consume anything.
+    seen = set()
+    # Bitmask of the supplied options that may be consumed from a node on.
+    ahead = {}
+
+    def append(next, node, cursor, mask, collected):
+        if isinstance(node, Split):
+            leaves = node.closure(argv.arguments[cursor]
+                                  if cursor < len(argv.arguments) else None)
+            if stats is not None:
+                stats.splits += 1
+                stats.forks += max(len(leaves) - 1, 0)
+                if stats.nodes is not None:
+                    counters = stats.node(node)
+                    counters[1] += 1
+                    counters[2] += max(len(leaves) - 1, 0)
+        else:
+            leaves = [node]
+        for leaf in leaves:
+            if id(leaf) not in ahead:
+                ahead[id(leaf)] = argv.mask(leaf.ahead)
+            if argv.all_options & ~mask & ~ahead[id(leaf)]:
+                if stats is not None:
+                    stats.pruned += 1
+                continue  # a supplied option can not be consumed anymore
+            key = (id(leaf), cursor, mask, id(collected))
+            if key not in seen:
+                seen.add(key)
+                next.append((leaf, cursor, mask, collected))
+            elif stats is not None:
+                stats.duplicates += 1
+
+    append(next, root, 0, 0, None)
     current = next
 
     while current:
+        if stats is not None:
+            stats.steps += 1
+            stats.states += len(current)
+            stats.peak_frontier = max(stats.peak_frontier, len(current))
         next = []
-        for node, args, collected in current:
-            if isinstance(node, End) and not args:
-                return collected
-            next_node = node.next(args, collected)
-            if next_node:
-                append(next, next_node, args, collected)
+        for node, cursor, mask, collected in current:
+            if stats is not None:
+                name = node.__class__.__name__
+                stats.visits[name] = stats.visits.get(name, 0) + 1
+                if stats.nodes is not None:
+                    stats.node(node)[1] += 1
+            if isinstance(node, End) and argv.done(cursor, mask):
+                if stats is not None:
+                    stats.end_step = stats.steps
+                return collect(collected)
+            state = node.next(argv, cursor, mask, collected)
+            if state is None and stats is not None and \
+                    stats.nodes is not None:
+                stats.node(node)[3] += 1
+            if state is not None:
+                node, cursor, mask, cell = state
+                if cell is not collected:
+                    if stats is not None:
+                        stats.cells += 1
+                    cell = interned.setdefault((cell[0], id(cell[1])), cell)
+                append(next, node, cursor, mask, cell)
         current = next
 
     return False
 
 
-def docopt(doc, argv=sys.argv[1:], help=True, version=None):
-    DocoptExit.usage = docopt.usage = usage = printable_usage(doc)
-    pot_options = parse_doc_options(doc)
-    root_node = parse_pattern(formal_usage(usage), options=pot_options)
-    flat = root_node.flat  # Must be retrieved before pattern is built
-    root_node.fix_list_arguments()
-    root_node = build_pattern(root_node)
-    argv = parse_args(argv, options=pot_options)
-    extras(help, version, argv, doc)
-    arguments = traverse(root_node, argv)
-    if arguments is not False:
+def dump_graph(roots):
+    """Flatten nodes reachable from `roots` into a marshallable table.
+
+    Nodes are referred to by their index in the table, so shared and
+    recursive nodes (like the `Split` closing a `OneOrMore` loop) survive
+    the round trip.
+
+    """
+    index, table, stack = {}, [], list(reversed(roots))
+    order = []
+    while stack:
+        node = stack.pop()
+        if node is None or id(node) in index:
+            continue
+        index[id(node)] = len(order)
+        order.append(node)
+        stack.extend(reversed([getattr(node, e) for e in node._edges]))
+    for node in order:
+        data = tuple((k, v) for k, v in sorted(node.__dict__.items())
+                     if k not in node._edges and k not in node._transient)
+        edges = tuple(-1 if getattr(node, e) is None
+                      else index[id(getattr(node, e))] for e in node._edges)
+        table.append((node.__class__.__name__, data, edges))
+    return table, [index[id(r)] for r in roots]
+
+
+def load_graph(table):
+    """Rebuild the nodes of a table made by `dump_graph`."""
+    classes = dict((c.__name__, c) for c in (Literal, Split, Argument,
+                                             Command, Option, AnyOptions, End))
+    nodes = []
+    for name, data, edges in table:
+        node = Fragment.__new__(classes[name])
+        node.__dict__.update(data)
+        node.tails = []
+        if isinstance(node, Split):
+            node._closures = {}
+        nodes.append(node)
+    for node, (name, data, edges) in zip(nodes, table):
+        for attr, i in zip(node._edges, edges):
+            setattr(node, attr, None if i == -1 else nodes[i])
+    return nodes
+
+
+# Called as profiler(phase, seconds, allocated) after each phase of
+# compiling a doc and parsing argv, see `PhaseProfiler`.
+profiler = None
+
+
+def _timed(phase, function, *args):
+    """Call `function(*args)`, reporting it to `profiler` as `phase`.
+
+    `allocated` is the change in memory traced by `tracemalloc`, or None
+    if it is not tracing.
+
+    """
+    if profiler is None:
+        return function(*args)
+    import time
+    clock = getattr(time, 'perf_counter', time.time)
+    tracemalloc = sys.modules.get('tracemalloc')
+    tracing = tracemalloc is not None and tracemalloc.is_tracing()
+    before = tracemalloc.get_traced_memory()[0] if tracing else None
+    start = clock()
+    try:
+        return function(*args)
+    finally:
+        seconds = clock() - start
+        allocated = (tracemalloc.get_traced_memory()[0] - before
+                     if tracing else None)
+        profiler(phase, seconds, allocated)
+
+
+class PhaseProfiler(object):
+
+    """Collect the phases of `docopt` calls made within a `with` block.
+
+    `phases` is a list of (phase, seconds, allocated) tuples, in the order
+    the phases ended. A profiler installed before is still called.
+
+    Note that a doc found in `parser_cache` is not compiled again, so only
+    the first call with it reports the compile phases.
+
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.previous = None
+
+    def __call__(self, phase, seconds, allocated):
+        self.phases.append((phase, seconds, allocated))
+        if self.previous is not None:
+            self.previous(phase, seconds, allocated)
+
+    def __enter__(self):
+        global profiler
+        self.previous, profiler = profiler, self
+        return self
+
+    def __exit__(self, *exc_info):
+        global profiler
+        profiler = self.previous
+
+    def totals(self):
+        """Total seconds spent in each phase."""
+        totals = {}
+        for phase, seconds, allocated in self.phases:
+            totals[phase] = totals.get(phase, 0) + seconds
+        return totals
+
+
+class Parser(object):
+
+    """Usage pattern compiled once from `doc`, reusable for many argv."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.usage = _timed('printable_usage', printable_usage, doc)
+        self.options = _timed('parse_doc_options', parse_doc_options, doc)
+        self.table = OptionTable(self.options)
+        pattern = _timed('parse_pattern', parse_pattern,
+                         _timed('formal_usage', formal_usage, self.usage),
+                         self.table, self.usage)
+        # Must be retrieved before pattern is built
+        self.arguments = [a for a in _timed('flat', getattr, pattern, 'flat')
+                          if type(a) in [Argument, Command]]
+        _timed('fix_list_arguments', pattern.fix_list_arguments)
+        self.root = _timed('build_pattern', build_pattern, pattern)
+
+    def parse(self, argv, help=True, version=None, stats=None):
+        DocoptExit.usage = self.usage
+        argv = _timed('parse_args', parse_args, argv, self.table)
+        _timed('extras', extras, help, version, argv, self.doc)
+        return self._match(argv, stats)
+
+    def parse_many(self, argvs, workers=None, chunksize=256):
+        """Parse each argv of `argvs` in turn, yielding a `Dict` for each.
+
+        Failures are yielded as `ParseError` instances instead of being
+        raised, so one bad argv does not end the batch. Help and version
+        options are not acted upon, they are only reported in the result.
+
+        With `workers`, argvs are matched by a pool of that many processes,
+        see `_parse_pool`; results are still yielded in the order of `argvs`.
+
+        """
+        if workers is not None:
+            for result in self._parse_pool(argvs, workers, chunksize):
+                yield result
+            return
+        for argv in argvs:
+            try:
+                yield self._match(_timed('parse_args', parse_args, argv,
+                                         self.table))
+            except DocoptExit:
+                yield ParseError(sys.exc_info()[1].message, self.usage)
+
+    def _parse_pool(self, argvs, workers, chunksize):
+        """Send `argvs` in chunks of `chunksize` to a process pool.
+
+        Each worker loads the compiled pattern once, from `dump`. At most
+        two chunks per worker are in flight, so `argvs` may be a stream.
+
+        """
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
+        from itertools import islice
+        argvs = iter(argvs)
+        executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                       initargs=(self.dump(),))
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < 2 * workers:
+                    chunk = list(islice(argvs, chunksize))
+                    if not chunk:
+                        break
+                    pending.append(executor.submit(_parse_chunk, chunk))
+                if not pending:
+                    break
+                for result in pending.popleft().result():
+                    yield result
+        finally:
+            for future in pending:  # if the caller stopped early
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _match(self, argv, stats=None):
+        arguments = _timed('traverse', traverse, self.root, argv, stats)
+        if arguments is False:
+            raise DocoptExit()
+        return _timed('Dict', self._result, argv, arguments)
+
+    def _result(self, argv, arguments):
         options = [o for o in argv if type(o) is Option]
-        pot_arguments = [a for a in flat
-                         if type(a) in [Argument, Command]]
-        return Dict((a.name, a.value) for a in
-                    (pot_options + options + pot_arguments + arguments))
-    raise DocoptExit()
+        # Lists are copied so that mutating the result (e.g. appending to
+        # an empty list argument) can not leak into the compiled pattern.
+        return Dict((a.name, list(a.value) if type(a.value) is list
+                     else a.value) for a in
+                    (self.options + options + self.arguments + arguments))
+
+    def dump(self):
+        table, roots = dump_graph([self.root] + self.options + self.arguments)
+        return (self.doc, self.usage, table, roots[0],
+                roots[1:len(self.options) + 1],
+                roots[len(self.options) + 1:])
+
+    @classmethod
+    def load(class_, data):
+        doc, usage, table, root, options, arguments = data
+        nodes = load_graph(table)
+        parser = class_.__new__(class_)
+        parser.doc, parser.usage, parser.root = doc, usage, nodes[root]
+        parser.options = [nodes[i] for i in options]
+        parser.table = OptionTable(parser.options)
+        parser.arguments = [nodes[i] for i in arguments]
+        return parser
+
+
+class HeatProfile(object):
+
+    """Per-node counters of `TraverseStats(nodes=True)`, mapped to `usage`.
+
+    `rows` lists (line, column, token, class name, entered, forked, failed)
+    for the tokens reached, hottest first; nodes built from the same token
+    (like the `Split` of each option in `[-ab]`) are added up. Line and
+    column (both from 1) locate the token in the usage section; they are
+    None for nodes without one, like `End` or the choice between usage
+    lines. It can be exported as collapsed stacks for flame graphs
+    (`collapsed`) or for callgrind viewers (`callgrind`).
+
+    """
+
+    def __init__(self, usage, stats):
+        self.usage = usage
+        locate = _usage_locator(usage)
+        formal = formal_usage(usage)
+        counters = {}
+        for node, entered, forked, failed in stats.nodes.values():
+            name = node.__class__.__name__
+            line = column = None
+            token = name
+            if node.position is not None and locate(node.position):
+                line, column = locate(node.position)
+                token = (node.name if isinstance(node, Option) else
+                         PatternTokenStream._token.match(
+                             formal, node.position).group())
+            total = counters.setdefault((line, column, token, name),
+                                        [0, 0, 0])
+            total[0] += entered
+            total[1] += forked
+            total[2] += failed
+        self.rows = sorted((key + tuple(total) for key, total in
+                            counters.items()),
+                           key=lambda r: (-sum(r[4:]), r[0] or 0, r[1] or 0,
+                                          r[2]))
+
+    def collapsed(self):
+        """Lines of `line N;token@N:C;event count` for flamegraph.pl."""
+        lines = []
+        for line, column, token, name, entered, forked, failed in self.rows:
+            frame = ('line %d;%s@%d:%d' % (line, token, line, column)
+                     if line is not None else '(no token);' + name)
+            for event, count in (('entered', entered), ('forked', forked),
+                                 ('failed', failed)):
+                if count:
+                    lines.append('%s;%s %d' % (frame, event, count))
+        return '\n'.join(lines) + '\n'
+
+    def callgrind(self):
+        """Profile in callgrind format, one function per node."""
+        out = ['version: 1', 'creator: docopt %s' % __version__,
+               'positions: line', 'events: Entered Forked Failed',
+               'fl=usage']
+        for line, column, token, name, entered, forked, failed in self.rows:
+            out.append('fn=%s' % ('%s@%d:%d' % (token, line, column)
+                                  if line is not None else name))
+            out.append('%d %d %d %d' % (line or 0, entered, forked, failed))
+        return '\n'.join(out) + '\n'
+
+
+def _usage_locator(usage):
+    """Map offsets in `formal_usage(usage)` to (line, column) in `usage`.
+
+    The formal pattern joins the words of `usage` with single spaces and
+    replaces the program name by `) | (`, so an offset is mapped through
+    the start of the word it falls in.
+
+    """
+    words = [(m.start(), m.group()) for m in re.finditer(r'\S+', usage)][1:]
+    starts, offsets, offset = [], [], 2  # after the leading '( '
+    for start, word in words[1:]:
+        if word == words[0][1]:
+            offset += len(') | (') + 1
+            continue
+        starts.append(offset)
+        offsets.append((start, len(word)))
+        offset += len(word) + 1
+
+    def locate(position):
+        i = bisect_left(starts, position + 1) - 1
+        if i < 0 or position - starts[i] >= offsets[i][1]:
+            return None  # a bracket or bar added by `formal_usage`
+        at = offsets[i][0] + position - starts[i]
+        return (usage.count('\n', 0, at) + 1,
+                at - usage.rfind('\n', 0, at))
+    return locate
+
+
+_worker_parser = None
+
+
+def _init_worker(data):
+    global _worker_parser
+    _worker_parser = Parser.load(data)
+
+
+def _parse_chunk(argvs):
+    return list(_worker_parser.parse_many(argvs))
+
+
+class ParserCache(object):
+
+    """Bounded LRU cache of `Parser` objects keyed by usage doc.
+
+    `maxsize` of None means unbounded, 0 disables caching.
+
+    If `directory` is set (by default from $DOCOPT_CACHE_DIR), compiled
+    parsers are also persisted there, keyed by a checksum of the doc, the
+    docopt version and the Python version, and loaded on later runs
+    instead of being compiled again.
+
+    It may be used from several threads. A doc is compiled outside of the
+    lock, so two threads missing the same doc may both compile it.
+
+    """
+
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        if directory is None:
+            import os
+            directory = os.environ.get('DOCOPT_CACHE_DIR') or None
+        self.directory = directory
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._parsers = {}
+            self._last_used = {}
+            self._tick = 0
+            self.hits = self.misses = self.evictions = self.disk_hits = 0
+
+    def get(self, doc):
+        with self._lock:
+            self._tick += 1
+            if doc in self._parsers:
+                self.hits += 1
+                self._last_used[doc] = self._tick
+                return self._parsers[doc]
+            self.misses += 1
+        parser = self._load(doc) if self.directory else None
+        loaded = parser is not None
+        if parser is None:
+            parser = Parser(doc)
+            if self.directory:
+                self._store(parser)
+        with self._lock:
+            if loaded:
+                self.disk_hits += 1
+            if self.maxsize is None or self.maxsize > 0:
+                self._tick += 1
+                self._parsers[doc] = parser
+                self._last_used[doc] = self._tick
+                self._evict()
+        return parser
+
+    def _evict(self):
+        """Drop least recently used parsers, with the lock held."""
+        while self.maxsize is not None and len(self._parsers) > self.maxsize:
+            oldest = min(self._last_used, key=self._last_used.get)
+            del self._parsers[oldest], self._last_used[oldest]
+            self.evictions += 1
+
+    def path(self, doc):
+        import marshal
+        import os
+        import zlib  # `_load` checks the doc, so a checksum is enough
+        key = '%s\0%s\0%s\0%s' % (__version__, sys.version_info[:2],
+                                    marshal.version, doc)
+        name = '%08x-%d.docopt' % (zlib.crc32(key.encode('utf-8')) &
+                                   0xffffffff, len(doc))
+        return os.path.join(os.path.expanduser(self.directory), name)
+
+    def _load(self, doc):
+        import marshal
+        try:
+            f = open(self.path(doc), 'rb')
+            try:
+                data = marshal.loads(f.read())  # load(f) reads in small bits
+            finally:
+                f.close()
+            parser = Parser.load(data)
+        except Exception:  # missing, stale or corrupt: just recompile
+            return None
+        return parser if parser.doc == doc else None
+
+    def _store(self, parser):
+        import marshal
+        import os
+        import tempfile
+        path = self.path(parser.doc)
+        tmp = None
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            f = os.fdopen(fd, 'wb')
+            try:
+                marshal.dump(parser.dump(), f)
+            finally:
+                f.close()
+            # Written aside and renamed, so readers never see partial files
+            getattr(os, 'replace', os.rename)(tmp, path)
+        except (IOError, OSError, ValueError):
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)  # the disk cache is best-effort
+
+    def info(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, size=len(self._parsers),
+                        maxsize=self.maxsize, disk_hits=self.disk_hits)
+
+    def __len__(self):
+        return len(self._parsers)
+
+    def __contains__(self, doc):
+        return doc in self._parsers
+
+
+parser_cache = ParserCache()
+
+
+_MATCHER_RUNTIME = r'''
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+class DocoptExit(SystemExit):
+
+    """Exit in case user invoked program with incorrect arguments."""
+
+    def __init__(self, message=''):
+        SystemExit.__init__(self, (message + '\n' + USAGE).strip())
+
+
+class Dict(dict):
+    def __repr__(self):
+        return '{%s}' % ',\n '.join('%r: %r' % i for i in sorted(self.items()))
+
+
+def parse_args(argv):
+    """Split argv into option (short, long, value) tuples and strings."""
+    tokens = argv.split() if isinstance(argv, basestring) else list(argv)
+    parsed, i = [], 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        if token == '--':
+            return parsed + tokens[i - 1:]
+        elif token.startswith('--'):
+            raw, eq, value = token.partition('=')
+            value = None if eq == value == '' else value
+            opt = [o for o in OPTIONS if [n for n in o[4]
+                                          if n.startswith('--') and
+                                          n.startswith(raw)]]
+            if len(opt) < 1:
+                raise DocoptExit('%s is not recognized' % raw)
+            if len(opt) > 1:
+                raise DocoptExit('%s is not a unique prefix: %s?' %
+                                 (raw, ', '.join(o[1] for o in opt)))
+            short, long, argcount = opt[0][:3]
+            if argcount == 1:
+                if value is None:
+                    if i == len(tokens):
+                        raise DocoptExit('%s requires argument' % long)
+                    value = tokens[i]
+                    i += 1
+            elif value is not None:
+                raise DocoptExit('%s must not have an argument' % long)
+            parsed.append((short, long, value or True))
+        elif token.startswith('-') and token != '-':
+            raw = token[1:]
+            while raw != '':
+                opt = [o for o in OPTIONS if [n for n in o[4]
+                                              if not n.startswith('--') and
+                                              n.lstrip('-')[:1] == raw[0]]]
+                if len(opt) > 1:
+                    raise DocoptExit('-%s is specified ambiguously %d times' %
+                                     (raw[0], len(opt)))
+                if len(opt) < 1:
+                    raise DocoptExit('-%s is not recognized' % raw[0])
+                short, long, argcount = opt[0][:3]
+                raw = raw[1:]
+                if argcount == 0:
+                    value = True
+                else:
+                    if raw == '':
+                        if i == len(tokens):
+                            raise DocoptExit('-%s requires argument' %
+                                             short[0])
+                        raw = tokens[i]
+                        i += 1
+                    value, raw = raw, ''
+                parsed.append((short, long, value))
+        else:
+            parsed.append(token)
+    return parsed
+
+
+def match(args):
+    """Simulate the usage NFA over args, return collected values or False.
+
+    A state is (node, cursor, mask, collected): a cursor into the
+    positional arguments, which are consumed in order, and a bitmask of
+    the consumed options, which may be consumed in any order. Collected
+    values are kept in a cons list of (name, value, is_list) whose cells
+    are interned, so that forking a branch copies nothing and states can
+    be deduplicated in constant time. States holding a supplied option
+    which can no longer be consumed (see `AHEAD`) are dropped.
+
+    """
+    arguments = [a for a in args if not isinstance(a, tuple)]
+    options = [a for a in args if isinstance(a, tuple)]
+    all_options = (1 << len(options)) - 1
+    masks = {}
+    for i, (short, long, value) in enumerate(options):
+        masks[short, long] = masks.get((short, long), 0) | 1 << i
+    interned, seen, ahead = {}, set(), {}
+
+    def append(frontier, i, cursor, mask, collected):
+        node = NODES[i]
+        if node[0] == 'Split':
+            append(frontier, node[1], cursor, mask, collected)
+            append(frontier, node[2], cursor, mask, collected)
+            return
+        if i not in ahead:
+            ahead[i] = all_options if AHEAD[i] is None else 0
+            for key in AHEAD[i] or ():
+                ahead[i] |= masks.get(key, 0)
+        if all_options & ~mask & ~ahead[i]:
+            return
+        if (i, cursor, mask, id(collected)) not in seen:
+            seen.add((i, cursor, mask, id(collected)))
+            frontier.append((node, cursor, mask, collected))
+
+    current = []
+    append(current, ROOT, 0, 0, None)
+    while current:
+        frontier = []
+        for node, cursor, mask, collected in current:
+            kind = node[0]
+            if kind == 'End':
+                if cursor == len(arguments) and mask == all_options:
+                    return collected
+                continue
+            elif kind in ('Argument', 'Command'):
+                if cursor == len(arguments):
+                    continue
+                arg = arguments[cursor]
+                if kind == 'Command':
+                    if arg != node[2]:
+                        continue
+                    arg = True
+                cell = ((node[2], arg, node[3]), collected)
+                collected = interned.setdefault((cell[0], id(collected)),
+                                                cell)
+                cursor += 1
+            elif kind == 'Option':
+                bits = masks.get(node[2:], 0)
+                if not bits & ~mask:
+                    continue
+                mask |= bits
+            elif kind == 'AnyOptions':
+                if not all_options & ~mask:
+                    continue
+                mask = all_options
+            append(frontier, node[1], cursor, mask, collected)
+        current = frontier
+    return False
+
+
+def docopt(argv=sys.argv[1:], help=True, version=None):
+    argv = parse_args(argv)
+    options = [a for a in argv if isinstance(a, tuple)]
+    names = [(short, long or short, value) for short, long, value in options]
+    if help and any(n in ('-h', '--help') and v for s, n, v in names):
+        print(DOC.strip())
+        sys.exit()
+    if version and any(n == '--version' and v for s, n, v in names):
+        print(version)
+        sys.exit()
+    collected = match(argv)
+    if collected is False:
+        raise DocoptExit()
+    result = Dict((o[1] or o[0], o[3]) for o in OPTIONS)
+    result.update((n, v) for s, n, v in names)
+    result.update((name, list(value) if isinstance(value, list) else value)
+                  for name, value in ARGUMENTS)
+    items, lists = [], {}
+    while collected:
+        item, collected = collected
+        items.append(item)
+    for name, value, is_list in reversed(items):
+        if is_list:
+            lists.setdefault(name, []).append(value)
+        else:
+            result[name] = value
+    result.update(lists)
+    return result
+
+
+if __name__ == '__main__':
+    print(docopt())
+'''
+
+
+def compile_to_source(doc):
+    """Return source of a standalone module that parses argv like `doc`.
+
+    The generated module has the compiled pattern baked in as tables and
+    exposes `docopt(argv=sys.argv[1:], help=True, version=None)`; it does
+    not import docopt at all.
+
+    """
+    parser = Parser(doc)
+    table, roots = dump_graph([parser.root])
+    nodes, ahead = [], []
+    for name, data, edges in table:
+        data = dict(data)
+        # Options which may be consumed from the node on, None for any
+        ahead.append(None if ANY in data['ahead'] else
+                     tuple(sorted(data['ahead'], key=repr)))
+        if name == 'Split':
+            nodes.append((name,) + edges)
+        elif name == 'End':
+            nodes.append((name,))
+        elif name == 'Argument':
+            nodes.append((name, edges[0], data['name'],
+                          isinstance(data['value'], list)))
+        elif name == 'Command':
+            nodes.append((name, edges[0], data['name'], False))
+        elif name == 'Option':
+            nodes.append((name, edges[0], data['short'], data['long']))
+        else:
+            nodes.append((name, edges[0]))
+    return ''.join([
+        '"""Argument parser generated by docopt %s from usage:\n\n' %
+        __version__,
+        parser.usage.replace('\\', '\\\\').replace('"""', '\\"\\"\\"'),
+        '\n\n"""\nimport sys\n\n\n',
+        'DOC = %r\n' % parser.doc,
+        'USAGE = %r\n' % parser.usage,
+        'OPTIONS = [\n%s]\n' % ''.join(
+            '    %r,\n' % ((o.short, o.long, o.argcount, o.value, o.names),)
+            for o in parser.options),
+        'ARGUMENTS = [\n%s]\n' % ''.join(
+            '    %r,\n' % ((a.name, a.value),) for a in parser.arguments),
+        'ROOT = %d\n' % roots[0],
+        'NODES = [\n%s]\n' % ''.join('    %r,\n' % (n,) for n in nodes),
+        'AHEAD = [\n%s]\n' % ''.join('    %r,\n' % (a,) for a in ahead),
+        _MATCHER_RUNTIME])
+
+
+def iter_parse(doc, lines):
+    """Shell-split each of `lines` and parse it, yielding a `Dict` for each.
+
+    Lines which can not be split or matched yield a `ParseError` instead,
+    see `Parser.parse_many`. `doc` is only compiled once and
+    lines are read one at a time, so `lines` may be an open file.
+
+    """
+    from shlex import split
+    parser = parser_cache.get(doc)
+    for line in lines:
+        try:
+            argv = split(line)
+        except ValueError:
+            yield ParseError(str(sys.exc_info()[1]), parser.usage)
+            continue
+        for result in parser.parse_many([argv]):
+            yield result
+
+
+# Prefix of requests from `remote_docopt`, which sends marshal data rather
+# than JSON, as importing json takes longer than the parse it asks for.
+_MARSHAL_TAG = ('marshal %d.%d ' % sys.version_info[:2]).encode('ascii')
+_NEWLINE = '\n'.encode('ascii')  # b'' literals need Python 2.6
+
+
+class _ParseProtocol(object):
+
+    """asyncio protocol answering one JSON or marshal request per line."""
+
+    def __init__(self, server):
+        self.server = server
+        self.buffer = ''.encode('ascii')
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while _NEWLINE in self.buffer:
+            line, self.buffer = self.buffer.split(_NEWLINE, 1)
+            if line.startswith('marshal '.encode('ascii')):
+                self.transport.write(self.marshal_reply(line))
+            else:
+                self.transport.write(self.json_reply(line))
+
+    def json_reply(self, line):
+        import json
+        try:
+            response = self.server.handle(json.loads(line.decode('utf-8')))
+        except (ValueError, KeyError, TypeError):
+            response = {'error': 'malformed request', 'usage': ''}
+        return json.dumps(response).encode('utf-8') + _NEWLINE
+
+    def marshal_reply(self, line):
+        import binascii
+        import marshal
+        if not line.startswith(_MARSHAL_TAG):
+            return _NEWLINE  # from another Python version, which falls back
+        try:
+            response = self.server.handle(marshal.loads(
+                binascii.a2b_base64(line[len(_MARSHAL_TAG):])))
+        except (ValueError, KeyError, TypeError, EOFError):
+            response = {'error': 'malformed request', 'usage': ''}
+        return binascii.b2a_base64(marshal.dumps(response))
+
+    def eof_received(self):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class ParseServer(object):
+
+    """Answer `remote_docopt` requests over a Unix socket.
+
+    A request is a JSON line with `doc`, `argv`, `help` and `version`; the
+    response is `{"result": ...}`, `{"extra": "help"}`, `{"extra":
+    "version"}` or `{"error": ..., "usage": ...}`, with `"language": true`
+    if the doc itself is invalid.
+
+    """
+
+    def __init__(self, path, maxsize=128):
+        self.path = path
+        self.parsers = ParserCache(maxsize, directory='')
+        self.loop = None
+
+    def handle(self, request):
+        try:
+            parser = self.parsers.get(request['doc'])
+        except DocoptLanguageError:
+            return {'error': str(sys.exc_info()[1]), 'language': True}
+        try:
+            argv = parse_args(request['argv'], parser.table)
+            shown = extra(request.get('help', True), request.get('version'),
+                          argv)
+            if shown is not None:
+                return {'extra': shown}
+            return {'result': dict(parser._match(argv))}
+        except DocoptExit:
+            return {'error': sys.exc_info()[1].message,
+                    'usage': parser.usage}
+
+    def serve_forever(self):
+        import asyncio
+        import os
+        import socket
+        import stat
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                raise socket.error('%s exists and is not a socket' %
+                                   self.path)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.remove(self.path)  # left over by a server which was killed
+            else:
+                raise socket.error('%s is in use by a running server' %
+                                   self.path)
+            finally:
+                probe.close()
+        self.loop = asyncio.new_event_loop()
+        server = self.loop.run_until_complete(self.loop.create_unix_server(
+            lambda: _ParseProtocol(self), self.path))
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def stop(self):
+        """Stop `serve_forever`, from any thread."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def remote_docopt(doc, argv=sys.argv[1:], help=True, version=None,
+                  path=None):
+    """Like `docopt`, but have the `ParseServer` at `path` match argv.
+
+    `path` defaults to $DOCOPT_SOCKET. Without a reachable server (running
+    the same Python version), `doc` is compiled in-process by `docopt`.
+
+    """
+    import os
+    path = path or os.environ.get('DOCOPT_SOCKET')
+    argv = argv.split() if isinstance(argv, basestring) else list(argv)
+    try:
+        import _socket as socket  # socket itself takes longer to import
+    except ImportError:
+        import socket
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return docopt(doc, argv, help, version)
+    import binascii
+    import marshal
+    request = binascii.b2a_base64(marshal.dumps(dict(
+        doc=doc, argv=argv, help=bool(help), version=version is not None)))
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(path)
+            connection.sendall(_MARSHAL_TAG + request)
+            data = connection.recv(65536)
+            while data and not data.endswith(_NEWLINE):
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            connection.close()
+        response = marshal.loads(binascii.a2b_base64(data))
+    except (socket.error, ValueError, TypeError, EOFError):
+        return docopt(doc, argv, help, version)
+    if response.get('language'):
+        raise DocoptLanguageError(response['error'])
+    if 'error' in response:
+        DocoptExit.usage = response['usage']
+        raise DocoptExit(response['error'])
+    if response.get('extra') == 'help':
+        print(doc.strip())
+        exit()
+    if response.get('extra') == 'version':
+        print(version)
+        exit()
+    return Dict(response['result'])
+
+
+def main(argv=None):
+    """Usage: docopt --emit [<file>]
+       docopt --doc=<usage> --stream [<file>]
+       docopt --serve=<socket>
+
+    --emit            Print a standalone module which parses argv according
+                      to the usage doc read from <file> (or stdin), see
+                      `compile_to_source`.
+    --doc=<usage>     File to read the usage doc from.
+    --stream          Parse each line of <file> (or stdin) as a command line,
+                      see `iter_parse`, and print one JSON object per line:
+                      the parsed arguments, or {"error": <message>} (just
+                      the usage if there is no more specific message).
+    --serve=<socket>  Answer parse requests on a Unix socket until killed,
+                      see `ParseServer` and `remote_docopt`.
+
+    """
+    arguments = docopt(main.__doc__, sys.argv[1:] if argv is None else argv)
+    if arguments['--serve']:
+        return ParseServer(arguments['--serve']).serve_forever()
+    f = open(arguments['<file>']) if arguments['<file>'] else sys.stdin
+    try:
+        if arguments['--emit']:
+            sys.stdout.write(compile_to_source(f.read()))
+        elif arguments['--stream']:
+            import json
+            d = open(arguments['--doc'])
+            try:
+                doc = d.read()
+            finally:
+                d.close()
+            for result in iter_parse(doc, f):
+                if isinstance(result, ParseError):
+                    result = {'error': result.message or result.usage}
+                sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def docopt(doc, argv=sys.argv[1:], help=True, version=None):
+    parser = parser_cache.get(doc)
+    docopt.usage = parser.usage
+    return parser.parse(argv, help, version)
+
+
+if __name__ == '__main__':
+    main()
@@ -588,46 +588,102 @@ $ prog -op
 {"-o": true, "-p": true, "-r": false}
 
 '''
-import sys, json
+from __future__ import print_function
+import sys, json, os
 from subprocess import Popen, PIPE, STDOUT
-
-
-testee = (sys.argv[1] if len(sys.argv) >= 2 else
-        exit('Usage: language_agnostic_tester.py ./path/to/executable/testee [ID ...]'))
-ids = [int(x) for x in sys.argv[2:]] if len(sys.argv) > 2 else None
-summary = ''
-
-index = 0
-for fixture in __doc__.split('r"""'):
-    doc, _, body = fixture.partition('"""')
-    for case in body.split('$')[1:]:
-        index += 1
-        if ids is not None and index not in ids:
-            continue
-        argv, _, expect = case.strip().partition('\n')
-        prog, _, argv = argv.strip().partition(' ')
-        assert prog == 'prog', repr(prog)
-        p = Popen(testee + ' ' + argv,
-                  stdout=PIPE, stdin=PIPE, stderr=STDOUT, shell=True)
-        result = p.communicate(input=doc)[0]
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+
+USAGE = ('Usage: language_agnostic_tester.py ./path/to/executable/testee '
+         '[--jobs=<n>] [ID ...]\n'
+         '       language_agnostic_tester.py --in-process [--jobs=<n>] '
+         '[ID ...]')
+
+
+def cases(ids=None):
+    # Yield (index, doc, argv, expect) for each case of the corpus above.
+    index = 0
+    for fixture in __doc__.split('r"""'):
+        doc, _, body = fixture.partition('"""')
+        for case in body.split('$')[1:]:
+            index += 1
+            if ids is not None and index not in ids:
+                continue
+            argv, _, expect = case.strip().partition('\n')
+            prog, _, argv = argv.strip().partition(' ')
+            assert prog == 'prog', repr(prog)
+            yield index, doc, argv, expect
+
+
+def run_testee(testee, doc, argv):
+    # Run `testee` on one case in a shell, with doc on its stdin.
+    p = Popen(testee + ' ' + argv,
+              stdout=PIPE, stdin=PIPE, stderr=STDOUT, shell=True)
+    return p.communicate(input=doc.encode('utf-8'))[0].decode('utf-8')
+
+
+def run_in_process(doc, argv):
+    # What testee.py prints, without starting an interpreter per case.
+    from shlex import split
+    from docopt import docopt, DocoptExit
+    try:
+        return json.dumps(docopt(doc, split(argv)))
+    except DocoptExit:
+        return '"user-error"'
+    except SystemExit:
+        return str(sys.exc_info()[1])
+
+
+def main(args):
+    jobs = None
+    for arg in [a for a in args if a.startswith('--jobs=')]:
+        jobs = int(arg[len('--jobs='):])
+        args.remove(arg)
+    if not args:
+        exit(USAGE)
+    testee, ids = args[0], [int(x) for x in args[1:]] or None
+    corpus = list(cases(ids))
+    docs, argvs = [c[1] for c in corpus], [c[2] for c in corpus]
+    if testee == '--in-process':
+        # Neighbouring cases share their doc, so sending them in chunks
+        # lets a worker reuse the compiled pattern.
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(run_in_process, docs, argvs,
+                                    chunksize=8))
+    else:
+        # Workers only wait for their testee, so threads are enough.
+        with ThreadPoolExecutor(jobs or 8) as pool:
+            results = list(pool.map(run_testee, [testee] * len(corpus),
+                                    docs, argvs))
+
+    summary = ''
+    for (index, doc, argv, expect), result in zip(corpus, results):
         try:
             py_result = json.loads(result)
             py_expect = json.loads(expect)
-        except:
+        except ValueError:
             summary += 'J'
-            print (' %d: BAD JSON ' % index).center(79, '=')
-            print 'result>', result
-            print 'expect>', expect
+            print((' %d: BAD JSON ' % index).center(79, '='))
+            print('result>', result)
+            print('expect>', expect)
             continue
         if py_result == py_expect:
             summary += '.'
         else:
-            print (' %d: FAILED ' % index).center(79, '=')
-            print 'r"""%s"""' % doc
-            print '$ prog %s\n' % argv
-            print 'result>', result
-            print 'expect>', expect
+            print((' %d: FAILED ' % index).center(79, '='))
+            print('r"""%s"""' % doc)
+            print('$ prog %s\n' % argv)
+            print('result>', result)
+            print('expect>', expect)
             summary += 'F'
 
-print (' %d / %d ' % (summary.count('.'), len(summary))).center(79, '=')
-print summary
+    print((' %d / %d ' % (summary.count('.'), len(summary))).center(79, '='))
+    print(summary)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,10 +1,11 @@
 #! /usr/bin/env python
+from __future__ import print_function
 from docopt import docopt, DocoptExit
 import sys, json
 
 doc = sys.stdin.read()
 
 try:
-    print json.dumps(docopt(doc))
+    print(json.dumps(docopt(doc)))
 except DocoptExit:
-    print '"user-error"'
+    print('"user-error"')
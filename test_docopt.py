@@ -4,7 +4,11 @@ from docopt import (docopt, DocoptExit, DocoptLanguageError,
                     Required, Optional, Either, OneOrMore, AnyOptions,
                     parse_args, parse_pattern,
                     parse_doc_options, printable_usage, formal_usage,
-                    build_pattern, traverse
+                    build_pattern, traverse, Parser, ParserCache,
+                    compile_to_source, ANY, collect, ParsedArgs,
+                    OptionTable, TokenStream, PatternTokenStream,
+                    iter_parse, ParseServer, remote_docopt,
+                    TraverseStats, PhaseProfiler, HeatProfile, ParseError
                    )
 from pytest import raises
 
@@ -51,6 +55,30 @@ def test_option():
                Option('-h', None, 1, '2')
 
 
+def test_option_aliases():
+    assert Option.parse('-v, -V, --verbose, --loud  Be loud.') == \
+            Option('-v', '--verbose', 0, False, ('-V', '--loud'))
+    assert Option('-v', '--verbose', 0, False, ('--loud',)).names == \
+            ('-v', '--verbose', '--loud')
+    doc = """usage: prog [options]
+
+    -v, -V, --verbose, --loud  Be loud.
+    -o FILE, -O FILE, --out=FILE, --output=FILE
+    """
+    for argv in ['-v', '-V', '--verbose', '--loud', '--lo', '-vV']:
+        assert docopt(doc, argv) == {'--verbose': True, '--out': None}
+    for argv in ['-o x', '-Ox', '--output=x', '--outp x', '-vOx']:
+        assert docopt(doc, argv)['--out'] == 'x'
+    assert docopt(doc, '--ou x')['--out'] == 'x'  # both name one option
+    generated = {}
+    exec(compile_to_source(doc), generated)
+    for argv in ['-V', '--lo', '-vOx', '--ou x']:
+        assert generated['docopt'](argv) == docopt(doc, argv)
+    table = OptionTable(parse_doc_options(doc))
+    assert table.match_short('V') == table.match_short('v')
+    assert len(table.match_long('--ou')) == 1
+
+
 def test_option_name():
     assert Option('-h', None).name == '-h'
     assert Option('-h', '--help').name == '--help'
@@ -302,11 +330,85 @@ def test_pattern_fix_list_arguments():
                         OneOrMore(Argument('N', [])))
 
 
+def test_long_patterns_compile():
+    names = ['<arg%04d>' % i for i in range(2000)]
+    pattern = parse_pattern('( %s %s )' % (' '.join(names), names[0]), [])
+    assert [a.name for a in pattern.flat] == names + names[:1]
+    pattern.fix_list_arguments()
+    assert pattern.flat[0].value == [] and pattern.flat[1].value is None
+    root = build_pattern(pattern)
+    collected = traverse(root, parse_args(names + ['x'], []))
+    assert collected[0] == Argument(names[0], [names[0], 'x'])
+    assert collected[1:] == [Argument(n, n) for n in names[1:]]
+    assert traverse(root, parse_args(names, [])) is False
+
+
+def test_fix_list_arguments_does_not_expand_cases():
+    choices = [Either(Argument('<a%d>' % i), Argument('N'), Command('go'))
+               for i in range(40)]
+    pattern = Required(OneOrMore(Either(*choices)), Argument('<b>'))
+    pattern.fix_list_arguments()
+    assert pattern.flat[1] == Argument('N', [])
+    assert pattern.flat[-1] == Argument('<b>', None)
+    assert Either(Argument('N'), Required(Argument('N'),
+                                          Argument('M'))).fix_list_arguments() \
+            == Either(Argument('N'), Required(Argument('N'), Argument('M')))
+
+
+def test_token_stream():
+    tokens = TokenStream('a b c', DocoptExit)
+    assert tokens.current() == 'a' and tokens.move() == 'a'
+    assert len(tokens) == 2 and list(tokens) == ['b', 'c']
+    assert tokens.move() == 'b' and tokens.move() == 'c'
+    assert tokens.current() is None and tokens.move() is None
+    assert len(tokens) == 0 and list(tokens) == []
+
+
+def test_pattern_token_stream():
+    tokens = PatternTokenStream('( <f>...|[-v] )')
+    assert list(tokens) == ['(', '<f>', '...', '|', '[', '-v', ']', ')']
+    assert tokens.move() == '(' and tokens.current() == '<f>'
+    assert tokens.position == 2 and len(tokens) == 7
+    with raises(DocoptLanguageError) as e:
+        parse_pattern('( a | b ) c )', [])
+    assert str(e.value).endswith('( a | b ) c )\n' + ' ' * 16 + '^')
+    with raises(DocoptLanguageError) as e:
+        docopt('usage: prog go\n       prog [a\n       prog b', '')
+    assert str(e.value) == ("Unmatched '[' at line 2, column 15:\n"
+                            "           prog [a\n" + ' ' * 18 + '^')
+    with raises(DocoptLanguageError) as e:
+        docopt('usage: prog --x\n\n--xa  A.\n--xb  B.', '')
+    assert 'at line 1, column 13:\n    usage: prog --x\n' in str(e.value)
+
+
 def test_set():
     assert Argument('N') == Argument('N')
     assert set([Argument('N'), Argument('N')]) == set([Argument('N')])
 
 
+def test_structural_equality():
+    a = Required(Argument('N'), Optional(Option('-a'), Command('go')))
+    b = Required(Argument('N'), Optional(Option('-a'), Command('go')))
+    assert a == b and hash(a) == hash(b) and not a != b
+    assert a != Required(Argument('N'), Optional(Option('-b'),
+                                                 Command('go')))
+    assert Argument('N') != Command('N') and Argument('N') != 'N'
+    b.children[1].children[1].value = True
+    assert a != b
+    b.children[1].children[1].value = False
+    assert a == b
+    assert Argument('N', []) == Argument('N', []) != Argument('N', ())
+    n, m = Argument('N', []), Argument('N', [])
+    assert n == m and hash(n) == hash(m)
+    n.value.append('x')  # leaves are never cached
+    assert n != m and hash(n) != hash(m)
+    c = Required(Argument('N'))
+    hash(c)
+    c.children[0].value = []
+    assert c.forget() == Required(Argument('N', []))
+    assert hash(c) == hash(Required(Argument('N', [])))
+
+
 def test_long_options_error_handling():
 #    with raises(DocoptLanguageError):
 #        docopt('Usage: prog --non-existent', '--non-existent')
@@ -455,3 +557,448 @@ def test_bug():
                   '') == {'<a>': None, '<b>': None}
     assert docopt('usage: prog <a> <b> \n prog',
                   '') == {'<a>': None, '<b>': None}
+
+
+def test_parser_cache():
+    cache = ParserCache(maxsize=2, directory='')
+    doc = 'usage: prog [NAME...]'
+    parser = cache.get(doc)
+    assert cache.get(doc) is parser
+    assert cache.info() == dict(hits=1, misses=1, evictions=0,
+                                size=1, maxsize=2, disk_hits=0)
+    cache.get('usage: prog a')
+    cache.get(doc)
+    cache.get('usage: prog b')  # evicts least recently used 'prog a'
+    assert doc in cache and 'usage: prog a' not in cache
+    assert cache.evictions == 1 and len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0 and cache.info()['misses'] == 0
+
+
+def test_parser_cache_threads():
+    import sys
+    import threading
+    cache, errors = ParserCache(maxsize=2, directory=''), []
+    docs = ['usage: prog %s' % c for c in 'abcdef']
+
+    def work():
+        try:
+            for i in range(200):
+                doc = docs[i % len(docs)]
+                assert cache.get(doc).doc == doc
+        except Exception:
+            errors.append(sys.exc_info()[1])
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == [] and len(cache) == 2
+    assert cache.hits + cache.misses == 1600
+
+
+def test_parser_cache_disabled():
+    cache = ParserCache(maxsize=0, directory='')
+    assert cache.get('usage: prog') is not cache.get('usage: prog')
+    assert len(cache) == 0 and cache.misses == 2
+
+
+def test_parser_is_reusable():
+    parser = Parser('usage: prog [NAME...] [-v]')
+    a = parser.parse('')
+    a['NAME'].append('x')
+    assert parser.parse('') == {'NAME': [], '-v': False}
+    assert parser.parse('1 2 -v') == {'NAME': ['1', '2'], '-v': True}
+    assert parser.parse('3') == {'NAME': ['3'], '-v': False}
+    with raises(DocoptExit):
+        parser.parse('-x')
+
+
+def test_parser_parse_many():
+    parser = Parser('usage: prog [NAME...] [-v] [-h]\n\n-h  Help.')
+    results = list(parser.parse_many(['1 2', '-x', ['-v'], '-h']))
+    assert results[0] == {'NAME': ['1', '2'], '-v': False, '-h': False}
+    assert isinstance(results[1], ParseError)
+    assert not isinstance(results[1], SystemExit)
+    assert results[1].message == '-x is not recognized'
+    assert results[1].usage == 'usage: prog [NAME...] [-v] [-h]'
+    assert str(results[1]) == '-x is not recognized\n' + results[1].usage
+    assert results[2] == {'NAME': [], '-v': True, '-h': False}
+    assert results[3] == {'NAME': [], '-v': False, '-h': True}
+
+
+def test_parser_parse_many_interleaved():
+    parser, results = Parser('usage: prog <x>'), []
+    for result in parser.parse_many(['a', '-x', 'b']):
+        results.append(result)
+        docopt('usage: other [-v]', '-v')  # sets DocoptExit.usage
+    assert results[0] == {'<x>': 'a'} and results[2] == {'<x>': 'b'}
+    assert str(results[1]) == '-x is not recognized\nusage: prog <x>'
+
+
+def test_parser_parse_many_workers():
+    parser = Parser('usage: prog [NAME...] [-v]')
+    argvs = ['%d -v' % i if i % 7 else '-x' for i in range(50)]
+    results = list(parser.parse_many(argvs, workers=2, chunksize=8))
+    expected = list(parser.parse_many(argvs))
+    assert [type(r) for r in results] == [type(r) for r in expected]
+    assert [str(r) for r in results] == [str(r) for r in expected]
+    results = parser.parse_many(argvs, workers=2, chunksize=1)
+    assert str(next(results)) == str(expected[0])
+    results.close()  # cancels the chunks still pending
+
+
+def test_parser_dump_and_load():
+    doc = """Usage: prog ship new <name>...
+              prog ship [<name>] move <x> <y> [--speed=<kn>]
+              prog mine (set|remove) <x> <y> [--moored|--drifting]
+              prog [NAME]...
+
+    --speed=<kn>  Speed in knots [default: 10].
+    --moored      Moored (anchored) mine.
+    --drifting    Drifting mine."""
+    import marshal
+    parser = Parser.load(marshal.loads(marshal.dumps(Parser(doc).dump())))
+    assert parser.parse('ship new a b') == Parser(doc).parse('ship new a b')
+    assert parser.parse('ship x move 1 2') == Parser(doc).parse(
+                                                        'ship x move 1 2')
+    assert parser.parse('a b c')['NAME'] == ['a', 'b', 'c']
+
+
+def test_parser_cache_on_disk(tmpdir):
+    import os
+    import docopt as module
+    doc = 'usage: prog <name>... [--all]'
+    cache = ParserCache(directory=str(tmpdir))
+    expected = cache.get(doc).parse('a b --all')
+    assert len(tmpdir.listdir()) == 1
+
+    cache = ParserCache(directory=str(tmpdir))
+    assert cache.get(doc).parse('a b --all') == expected
+    assert cache.disk_hits == 1
+
+    tmpdir.listdir()[0].write('garbage')
+    cache = ParserCache(directory=str(tmpdir))
+    assert cache.get(doc).parse('a b --all') == expected
+    assert cache.disk_hits == 0
+
+    # A file holding another doc, as after a checksum collision, is unused
+    other = 'usage: prog <x>'
+    tmpdir.join(os.path.basename(cache.path(doc))).copy(
+        tmpdir.join(os.path.basename(cache.path(other))))
+    cache = ParserCache(directory=str(tmpdir))
+    assert cache.get(other).parse('1') == {'<x>': '1'}
+    assert cache.disk_hits == 0
+
+    version = module.__version__
+    try:
+        module.__version__ = version + '.post1'
+        cache = ParserCache(directory=str(tmpdir))
+        cache.get(doc)
+        assert cache.disk_hits == 0 and len(tmpdir.listdir()) == 3
+    finally:
+        module.__version__ = version
+
+
+def language_agnostic_cases():
+    """Yield (doc, argv) for every case of the language agnostic corpus."""
+    import os
+    path = os.path.join(os.path.dirname(__file__), 'language_agnostic_test',
+                        'language_agnostic_tester.py')
+    corpus = open(path).read().split("\'\'\'")[1]
+    for fixture in corpus.split('r"""')[1:]:
+        doc, _, body = fixture.partition('"""')
+        for case in body.split('$')[1:]:
+            argv, _, expect = case.strip().partition('\n')
+            yield doc, argv.strip().partition(' ')[2]
+
+
+def test_compile_to_source():
+    docs = {}
+    for doc, argv in language_agnostic_cases():
+        if doc not in docs:
+            namespace = {'__name__': 'generated'}
+            exec(compile(compile_to_source(doc), 'generated', 'exec'),
+                 namespace)
+            docs[doc] = namespace
+        generated = docs[doc]
+        try:
+            expected = docopt(doc, argv)
+        except DocoptExit:
+            with raises(generated['DocoptExit']):
+                generated['docopt'](argv)
+        else:
+            assert generated['docopt'](argv) == expected
+    assert len(docs) > 30
+
+
+def test_compile_to_source_match_many():
+    namespace, names = {}, [str(i) for i in range(2000)]
+    exec(compile_to_source('usage: prog [-v] <name>...'), namespace)
+    assert namespace['docopt'](names[:1000] + ['-v'] + names[1000:]) == \
+            {'<name>': names, '-v': True}
+
+
+def test_compile_to_source_drops_states_with_unconsumable_options():
+    names = ['--option-%02d' % i for i in range(40)]
+    namespace = {}
+    exec(compile_to_source('usage: prog %s' % ' '.join('[%s]' % n
+                                                       for n in names)),
+         namespace)
+    assert namespace['docopt'](names[::2]) == \
+            dict((n, i % 2 == 0) for i, n in enumerate(names))
+
+
+def test_compile_to_source_list_arguments_are_fresh():
+    namespace = {}
+    exec(compile_to_source('usage: prog [NAME...]'), namespace)
+    namespace['docopt']('')['NAME'].append('x')
+    assert namespace['docopt']('') == {'NAME': []}
+    assert namespace['docopt']('a b') == {'NAME': ['a', 'b']}
+
+
+def test_main_emit(tmpdir, capsys):
+    from docopt import main
+    path = tmpdir.join('usage.txt')
+    path.write('usage: prog <x> [-v]')
+    main(['--emit', str(path)])
+    namespace = {}
+    exec(capsys.readouterr()[0], namespace)
+    assert namespace['docopt']('-v 1') == {'<x>': '1', '-v': True}
+
+
+def test_iter_parse():
+    results = list(iter_parse('usage: prog <x> [-v]',
+                              ['1 -v\n', '"a b"', '-x', '"open']))
+    assert results[:2] == [{'<x>': '1', '-v': True},
+                           {'<x>': 'a b', '-v': False}]
+    assert [type(r) for r in results[2:]] == [ParseError, ParseError]
+
+
+def test_main_stream(tmpdir, capsys):
+    from docopt import main
+    import json
+    doc, lines = tmpdir.join('usage.txt'), tmpdir.join('lines.txt')
+    doc.write('usage: prog <x> [-v]')
+    lines.write('1 -v\n\n-x\n')
+    main(['--doc', str(doc), '--stream', str(lines)])
+    assert [json.loads(l) for l in capsys.readouterr()[0].splitlines()] == [
+        {'<x>': '1', '-v': True}, {'error': 'usage: prog <x> [-v]'},
+        {'error': '-x is not recognized'}]
+
+
+def test_parse_server_handle():
+    server, doc = ParseServer(None), 'usage: prog <x> [-v]'
+    assert server.handle({'doc': doc, 'argv': ['1']}) == \
+            {'result': {'<x>': '1', '-v': False}}
+    assert server.handle({'doc': doc, 'argv': ['-x']}) == \
+            {'error': '-x is not recognized', 'usage': 'usage: prog <x> [-v]'}
+    assert server.handle({'doc': 'no usage', 'argv': []})['language']
+    assert 'no usage' not in server.parsers
+    doc = 'usage: prog <x>\n\n-h  Help.\n--version  Version.'
+    assert server.handle({'doc': doc, 'argv': ['-h']}) == {'extra': 'help'}
+    assert server.handle({'doc': doc, 'argv': ['-h'], 'help': False}) == \
+            {'error': '', 'usage': 'usage: prog <x>'}
+    assert server.handle({'doc': doc, 'argv': ['1', '--version'],
+                          'version': True}) == {'extra': 'version'}
+    server = ParseServer(None, maxsize=2)
+    for x in 'abc':
+        server.handle({'doc': 'usage: prog %s' % x, 'argv': [x]})
+    assert server.parsers.info()['evictions'] == 1
+    assert 'usage: prog a' not in server.parsers
+
+
+def test_remote_docopt(tmpdir, capsys):
+    import socket
+    import threading
+    import time
+    path = str(tmpdir.join('docopt.sock'))
+    tmpdir.join('plain').write('keep me')
+    server = ParseServer(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        while server.loop is None or not server.loop.is_running():
+            time.sleep(0.01)
+        doc = 'usage: prog <x> [-v]'
+        assert remote_docopt(doc, '1 -v', path=path) == {'<x>': '1',
+                                                         '-v': True}
+        assert doc in server.parsers
+        with raises(DocoptExit):
+            remote_docopt(doc, '-x', path=path)
+        with raises(DocoptLanguageError):
+            remote_docopt('no usage', '', path=path)
+        doc = 'usage: prog <x>\n\n-h  Help.\n--version  Version.'
+        with raises(SystemExit):
+            remote_docopt(doc, '-h', path=path)
+        assert capsys.readouterr()[0] == doc + '\n'
+        with raises(SystemExit):
+            remote_docopt(doc, '1 --version', version='1.0', path=path)
+        assert capsys.readouterr()[0] == '1.0\n'
+        # Other clients speak JSON, and marshal data of another Python
+        # version is answered with an empty line
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        f = client.makefile('rwb')
+        f.write('marshal 0.0 e30=\n{"doc": "usage: prog <x>", "argv": ["3"]}\n'
+                .encode('ascii'))
+        f.flush()
+        assert f.readline() == '\n'.encode('ascii')
+        assert f.readline() == '{"result": {"<x>": "3"}}\n'.encode('ascii')
+        f.close()
+        client.close()
+        with raises(socket.error):
+            ParseServer(path).serve_forever()
+        with raises(socket.error):
+            ParseServer(str(tmpdir.join('plain'))).serve_forever()
+    finally:
+        server.stop()
+        thread.join()
+    assert tmpdir.join('plain').read() == 'keep me'
+    # Without a server, doc is compiled in-process
+    assert remote_docopt('usage: prog <x>', '2', path=path) == {'<x>': '2'}
+
+
+def test_determinize():
+    root = build_pattern(parse_pattern('( a <x> ) | ( b [-v] ) | ( [-v] )',
+                                       options=[Option('-v')]))
+    assert root.first == frozenset(['a', 'b', None])
+    assert [n.name for n in root.closure('a')] == ['a']
+    assert root.closure('a')[0]._next.first == frozenset([ANY])
+    assert [n.name for n in root.closure('b')] == ['b']
+    assert len(root.closure(None)) == 2  # [-v] may be skipped or taken
+    assert root.closure('c') == root.closure('d') == []
+    assert traverse(root, [Argument(None, 'b'), Option('-v')]) == \
+            [Command('b', True)]
+    assert traverse(root, [Argument(None, 'c')]) is False
+
+
+def test_determinize_one_or_more():
+    root = build_pattern(parse_pattern('( go <x>... )', options=[]))
+    assert root.first == frozenset(['go'])
+    assert traverse(root, [Argument(None, 'go'), Argument(None, 'go')]) == \
+            [Command('go', True), Argument('<x>', 'go')]
+
+
+def test_traverse_deduplicates_states():
+    doc = 'usage: prog ' + ' '.join('[-%s]' % c for c in 'abcdefghijklmnop')
+    assert docopt(doc, '-p -a')['-p'] is True
+    with raises(DocoptExit):  # used to loop forever
+        docopt('usage: prog [NAME]...\n\n-x', '-x')
+    assert docopt('usage: prog [NAME]...\n\n-x', 'a b') == \
+            {'NAME': ['a', 'b'], '-x': False}
+
+
+def test_traverse_stats():
+    parser = Parser('usage: prog [-v] (go <x> | stop <x>)')
+    stats = TraverseStats()
+    assert parser.parse('go 1 -v', stats=stats)['<x>'] == '1'
+    assert stats.end_step == stats.steps
+    assert stats.visits['Command'] == 1 and stats.visits['End'] == 1
+    assert stats.states == sum(stats.visits.values()) >= stats.peak_frontier
+    assert stats.cells == 2  # go and <x>, options are not collected
+    stats = TraverseStats()
+    with raises(DocoptExit):
+        parser.parse('go', stats=stats)
+    assert stats.end_step is None and stats.steps > 0
+    stats = TraverseStats()
+    traverse(build_pattern(parse_pattern('[NAME]...', [])),
+             [Argument(None, 'a'), Argument(None, 'b')], stats)
+    assert stats.splits > 0 and stats.duplicates > 0
+
+
+def test_heat_profile():
+    parser = Parser('usage: prog go <x> [-ab]\n'
+                    '       prog stop\n\n-a  A.\n-b  B.')
+    stats = TraverseStats(nodes=True)
+    parser.parse('go 1 -b', stats=stats)
+    with raises(DocoptExit):
+        parser.parse('stop 1', stats=stats)
+    profile = HeatProfile(parser.usage, stats)
+    rows = dict(((r[0], r[1], r[2]), r[4:]) for r in profile.rows)
+    assert rows[1, 13, 'go'] == (1, 0, 0)
+    assert rows[1, 16, '<x>'] == (1, 0, 0)
+    assert rows[1, 20, '['] == (1, 2, 0)
+    assert rows[1, 22, '-a'] == (1, 0, 1)
+    assert rows[1, 23, '-b'] == (1, 0, 0)  # columns of the letters
+    assert rows[2, 13, 'stop'] == (1, 0, 0)
+    assert rows[None, None, 'End'] == (2, 0, 1)
+    assert 'line 1;<x>@1:16;entered 1\n' in profile.collapsed()
+    callgrind = profile.callgrind()
+    assert 'events: Entered Forked Failed\n' in callgrind
+    assert 'fn=-b@1:23\n1 1 0 0\n' in callgrind
+
+
+def test_phase_profiler():
+    import docopt as module
+    import tracemalloc
+    calls = []
+    module.profiler = lambda *phase: calls.append(phase)
+    try:
+        tracemalloc.start()
+        with PhaseProfiler() as profiler:
+            Parser('usage: prog [-v] <x>').parse('1')
+        tracemalloc.stop()
+    finally:
+        module.profiler = None
+    assert [p[0] for p in profiler.phases] == [
+        'printable_usage', 'parse_doc_options', 'formal_usage',
+        'parse_pattern', 'flat', 'fix_list_arguments', 'build_pattern',
+        'parse_args', 'extras', 'traverse', 'Dict']
+    assert calls == profiler.phases
+    assert all(s >= 0 and a is not None for p, s, a in profiler.phases)
+    assert set(profiler.totals()) == set(p[0] for p in profiler.phases)
+    docopt('usage: prog', '')  # not profiled anymore
+    assert len(profiler.phases) == 11
+
+
+def test_collect():
+    assert collect(None) == []
+    collected = None
+    for item in [(Argument, 'N', '1', True), (Command, 'go', True, False),
+                 (Argument, 'N', '2', True), (Argument, 'M', '3', False)]:
+        collected = (item, collected)
+    assert collect(collected) == [Argument('N', ['1', '2']),
+                                  Command('go', True), Argument('M', '3')]
+
+
+def test_list_argument_match_many():
+    names = [str(i) for i in range(2000)]
+    assert docopt('usage: prog <name>...', names) == {'<name>': names}
+
+
+def test_parsed_args():
+    argv = ParsedArgs([Option('-a'), Argument(None, 'x'), Option('-b'),
+                       Argument(None, 'y')])
+    assert argv.arguments == ['x', 'y']
+    assert argv.options == [Option('-a'), Option('-b')]
+    assert argv.all_options == 3
+    assert not argv.done(2, 1) and not argv.done(1, 3) and argv.done(2, 3)
+    state = Option('-b').next(argv, 0, 0, None)
+    assert state[1:] == (0, 2, None)
+    assert Option('-b').next(argv, 0, 2, None) is None
+
+
+def test_traverse_drops_states_with_unconsumable_options():
+    names = ['--option-%02d' % i for i in range(40)]
+    doc = 'usage: prog %s' % ' '.join('[%s]' % n for n in names)
+    assert docopt(doc, names[::2]) == \
+            dict((n, i % 2 == 0) for i, n in enumerate(names))
+    root = build_pattern(parse_pattern('-a [-b] [options]',
+                                       options=[Option('-a'), Option('-b')]))
+    assert root.ahead == frozenset([('-a', None), ('-b', None), ANY])
+
+
+def test_option_table_match_long():
+    options = [Option(None, '--verbose'), Option('-v'),
+               Option(None, '--version'), Option(None, '--all')]
+    table = OptionTable(options)
+    assert table.match_long('--ver') == [options[0], options[2]]
+    assert table.match_long('--versi') == [options[2]]
+    assert table.match_long('--x') == table.match_long('--allx') == []
+    table.append(Option(None, '--verb'))
+    assert options[-1] == Option(None, '--verb')
+    assert table.match_long('--verb') == [options[0], options[-1]]
+    with raises(DocoptExit) as e:
+        docopt('usage: prog [--verbose --version]', '--ver')
+    assert '--verbose, --version' in str(e.value)